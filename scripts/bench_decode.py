@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import gflags
+import os
+import sys
+import time
+
+gflags.DEFINE_string('image_dir', None, 'Image directory')
+gflags.DEFINE_string('processor', 'train', 'One of "train" or "test"')
+gflags.DEFINE_integer('num_images', 256, 'Number of images to decode')
+gflags.DEFINE_integer('num_rounds', 3, 'Timed rounds per setting')
+
+gflags.MarkFlagsAsRequired(['image_dir'])
+FLAGS = gflags.FLAGS
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    import tensorflow as tf
+
+    from slender.manifest import walk
+    from slender.processor import TrainProcessor, TestProcessor
+
+    file_paths = []
+    for (file_dir, _, file_names) in walk(FLAGS.image_dir, followlinks=True):
+        file_paths.extend([
+            os.path.join(file_dir, file_name)
+            for file_name in file_names
+            if file_name.endswith('.jpg')
+        ])
+        if len(file_paths) >= FLAGS.num_images:
+            break
+
+    contents = []
+    for file_path in file_paths[:FLAGS.num_images]:
+        with open(file_path, 'rb') as f:
+            contents.append(f.read())
+
+    Processor = {'train': TrainProcessor, 'test': TestProcessor}[FLAGS.processor]
+
+    for scaled_decode in [False, True]:
+        with tf.Graph().as_default():
+            processor = Processor(scaled_decode=scaled_decode)
+            content = tf.placeholder(tf.string, shape=())
+            image = processor.decode_jpeg(content)
+
+            with tf.Session() as sess:
+                sess.run(image, feed_dict={content: contents[0]})
+
+                start = time.time()
+                for num_round in xrange(FLAGS.num_rounds):
+                    for content_ in contents:
+                        sess.run(image, feed_dict={content: content_})
+                interval = (time.time() - start) / (FLAGS.num_rounds * len(contents))
+
+        print('scaled_decode={}: {:.2f} ms/image (decode_dim={})'.format(
+            scaled_decode,
+            1000 * interval,
+            processor.decode_dim,
+        ))
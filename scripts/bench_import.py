@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import gflags
+import json
+import subprocess
+import sys
+
+gflags.DEFINE_list('modules', ['slender.factory', 'slender.util', 'slender.manifest'], 'Modules to import')
+gflags.DEFINE_list('forbidden', ['tensorflow'], 'Modules that must not be loaded as a side effect')
+gflags.DEFINE_float('budget', 0.5, 'Import time budget per module, in seconds')
+gflags.DEFINE_integer('num_rounds', 3, 'Fresh interpreters per module, the fastest one counts')
+FLAGS = gflags.FLAGS
+
+# each import runs in a fresh interpreter, so nothing is cached in sys.modules
+SNIPPET = '''
+import json, sys, time
+start = time.time()
+__import__({module!r})
+print(json.dumps({{
+    'interval': time.time() - start,
+    'loaded': [name for name in {forbidden!r} if name in sys.modules],
+}}))
+'''
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    is_ok = True
+    for module in FLAGS.modules:
+        results = [
+            json.loads(subprocess.check_output([
+                sys.executable,
+                '-c',
+                SNIPPET.format(module=module, forbidden=FLAGS.forbidden),
+            ]))
+            for num_round in xrange(FLAGS.num_rounds)
+        ]
+        interval = min(result['interval'] for result in results)
+        loaded = results[0]['loaded']
+
+        is_module_ok = (interval <= FLAGS.budget) and (not loaded)
+        is_ok = is_ok and is_module_ok
+
+        print('{:s}: {:.3f} s (budget {:.3f} s){:s} {:s}'.format(
+            module,
+            interval,
+            FLAGS.budget,
+            ', loaded {:s}'.format(', '.join(loaded)) if loaded else '',
+            'OK' if is_module_ok else 'FAIL',
+        ))
+
+    sys.exit(0 if is_ok else 1)
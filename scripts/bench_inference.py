@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import gflags
+import numpy as np
+import os
+import sys
+import time
+
+gflags.DEFINE_string('image_dir', None, 'Image directory, one subdir per class')
+gflags.DEFINE_string('working_dir_root', None, 'Root working directory')
+gflags.DEFINE_integer('batch_size', 16, 'Batch size')
+gflags.DEFINE_integer('num_images', 512, 'Number of images to score')
+gflags.DEFINE_integer('num_rounds', 3, 'Timed rounds per setting')
+
+gflags.MarkFlagsAsRequired(['image_dir', 'working_dir_root'])
+FLAGS = gflags.FLAGS
+
+SETTINGS = [
+    ('float32', dict()),
+    ('float32+fold', dict(fold_batch_norm=True)),
+    ('float16+fold', dict(fold_batch_norm=True, precision='float16')),
+    ('int8+fold', dict(fold_batch_norm=True, precision='int8')),
+]
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    import tensorflow as tf
+
+    from slender.manifest import walk
+    from slender.producer import PlaceholderProducer as Producer
+    from slender.processor import TestProcessor as Processor
+    from slender.net import ClassifyNet, OnlineScheme
+    from slender.util import latest_working_dir
+
+    class Net(ClassifyNet, OnlineScheme):
+        pass
+
+    working_dir = latest_working_dir(FLAGS.working_dir_root)
+    class_names = list(Producer(working_dir=working_dir).class_names)
+
+    file_paths = []
+    labels = []
+    for (file_dir, _, file_names) in walk(FLAGS.image_dir, followlinks=True):
+        class_name = os.path.relpath(file_dir, FLAGS.image_dir).split(os.sep)[0]
+        if class_name not in class_names:
+            continue
+
+        for file_name in file_names:
+            if file_name.endswith('.jpg'):
+                file_paths.append(os.path.join(file_dir, file_name))
+                labels.append(class_names.index(class_name))
+
+    indices = np.random.RandomState(1337).permutation(len(file_paths))[:FLAGS.num_images]
+    file_paths = np.array(file_paths)[indices]
+    labels = np.array(labels)[indices]
+    batches = [
+        slice(offset, offset + FLAGS.batch_size)
+        for offset in xrange(0, len(file_paths), FLAGS.batch_size)
+    ]
+
+    baseline = None
+    for (name, kwargs) in SETTINGS:
+        with tf.Graph().as_default():
+            producer = Producer(
+                working_dir=working_dir,
+                batch_size=FLAGS.batch_size,
+            )
+            processor = Processor(
+                batch_size=FLAGS.batch_size,
+            )
+            net = Net(
+                working_dir=working_dir,
+                num_classes=producer.num_classes,
+                **kwargs
+            )
+            blob = (
+                producer.blob()
+                .f(processor.preprocess)
+                .f(net.build)
+                .f(processor.postprocess)
+            )
+            net.run()
+
+            def predict(batch):
+                return net.sess.run(blob['predictions'], feed_dict={producer.file_names: file_paths[batch]})
+
+            predictions = np.concatenate(map(predict, batches))
+
+            start = time.time()
+            for num_round in xrange(FLAGS.num_rounds):
+                for batch in batches:
+                    predict(batch)
+            interval = (time.time() - start) / (FLAGS.num_rounds * len(batches))
+
+            net.sess.close()
+
+        if baseline is None:
+            baseline = predictions
+
+        print('{:s}: {:.1f} ms/batch, accuracy={:.4f}, agreement={:.4f}, max_diff={:.4g}'.format(
+            name,
+            1000 * interval,
+            np.mean(np.argmax(predictions, 1) == labels),
+            np.mean(np.argmax(predictions, 1) == np.argmax(baseline, 1)),
+            np.max(np.abs(predictions - baseline)),
+        ))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import gflags
+import sys
+import time
+
+gflags.DEFINE_string('image_dir', None, 'Image directory')
+gflags.DEFINE_string('working_dir', None, 'Working directory')
+gflags.DEFINE_string('producer', 'dataset', 'One of "queue" or "dataset"')
+gflags.DEFINE_integer('batch_size', 64, 'Batch size')
+gflags.DEFINE_integer('num_parallels', 8, 'Number of parallel operations')
+gflags.DEFINE_integer('num_warmup_steps', 10, 'Steps before timing starts')
+gflags.DEFINE_integer('num_steps', 100, 'Timed steps')
+
+gflags.MarkFlagsAsRequired(['image_dir', 'working_dir'])
+FLAGS = gflags.FLAGS
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    import tensorflow as tf
+
+    from slender.producer import LocalFileProducer, DatasetProducer
+    from slender.processor import TrainProcessor as Processor
+
+    processor = Processor(
+        batch_size=FLAGS.batch_size,
+    )
+    if FLAGS.producer == 'queue':
+        producer = LocalFileProducer(
+            image_dir=FLAGS.image_dir,
+            working_dir=FLAGS.working_dir,
+            batch_size=FLAGS.batch_size,
+            num_parallels=FLAGS.num_parallels,
+        )
+    elif FLAGS.producer == 'dataset':
+        producer = DatasetProducer(
+            image_dir=FLAGS.image_dir,
+            working_dir=FLAGS.working_dir,
+            batch_size=FLAGS.batch_size,
+            num_parallels=FLAGS.num_parallels,
+            processor=processor,
+        )
+
+    blob = producer.blob().f(processor.preprocess)
+
+    with tf.Session() as sess:
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+
+        for num_step in xrange(FLAGS.num_warmup_steps):
+            sess.run(blob['images'])
+
+        start = time.time()
+        for num_step in xrange(FLAGS.num_steps):
+            sess.run(blob['images'])
+        interval = time.time() - start
+
+        print('{:s}: {:.1f} images/sec'.format(FLAGS.producer, FLAGS.num_steps * FLAGS.batch_size / interval))
+
+        coord.request_stop()
+        coord.join(threads)
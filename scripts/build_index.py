@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import gflags
+import glob
+import numpy as np
+import os
+import sys
+
+gflags.DEFINE_string('score_dir', None, 'Output directory of scripts/score.py, scored with --save_feats')
+gflags.DEFINE_string('index_dir', None, 'Index directory, created or extended')
+gflags.DEFINE_string('backend', 'brute_force', 'One of "brute_force" or "ivfpq"')
+gflags.DEFINE_bool('normalize', True, 'Index unit vectors, so that neighbours are by cosine similarity')
+gflags.DEFINE_integer('num_lists', 1024, 'Inverted lists of the ivfpq backend')
+gflags.DEFINE_integer('num_subspaces', 16, 'Product quantizer subspaces of the ivfpq backend')
+gflags.DEFINE_integer('num_train', 262144, 'Vectors sampled to train the ivfpq backend')
+
+gflags.MarkFlagsAsRequired(['score_dir', 'index_dir'])
+FLAGS = gflags.FLAGS
+
+# ids are line numbers in the path list, chunks already in the index are listed and skipped
+PATHS_FILE_NAME = 'paths.txt'
+
+# each line is a chunk name and the number of rows once it was indexed, written last per chunk
+CHUNKS_FILE_NAME = 'chunks.txt'
+
+
+def read_chunks(path):
+    chunks = []
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                # a torn last line, the chunk it names was not completely indexed
+                if (not line.endswith('\n')) or (len(fields) != 2):
+                    break
+                chunks.append((fields[0], int(fields[1])))
+    return chunks
+
+
+def truncate_lines(path, num_lines):
+    if not os.path.isfile(path):
+        return
+
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    if len(lines) == num_lines:
+        return
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines[:num_lines])
+    os.rename(tmp_path, path)
+
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    from slender.index import BruteForceIndex, IVFPQIndex
+
+    chunk_names = sorted([
+        os.path.basename(path)[:-len('.paths.txt')]
+        for path in glob.glob(os.path.join(FLAGS.score_dir, 'chunk-*.paths.txt'))
+    ])
+    if not chunk_names:
+        sys.exit('No scored chunks in {:s}'.format(FLAGS.score_dir))
+
+    def load(chunk_name):
+        feats = np.load(os.path.join(FLAGS.score_dir, chunk_name + '.feats_2048.npy'), mmap_mode='r')
+        paths = np.loadtxt(os.path.join(FLAGS.score_dir, chunk_name + '.paths.txt'), dtype=np.str, ndmin=1)
+        is_valid = ~np.isnan(feats[:, 0])
+        return (np.asarray(feats[is_valid], dtype=np.float32), paths[is_valid])
+
+    dim = np.load(os.path.join(FLAGS.score_dir, chunk_names[0] + '.feats_2048.npy'), mmap_mode='r').shape[1]
+    if FLAGS.backend == 'brute_force':
+        index = BruteForceIndex(dim, index_dir=FLAGS.index_dir, normalize=FLAGS.normalize)
+    elif FLAGS.backend == 'ivfpq':
+        index = IVFPQIndex(
+            dim,
+            index_dir=FLAGS.index_dir,
+            normalize=FLAGS.normalize,
+            num_lists=FLAGS.num_lists,
+            num_subspaces=FLAGS.num_subspaces,
+        )
+
+        if not index.is_trained():
+            feats = []
+            num_feats = 0
+            for chunk_name in chunk_names:
+                (chunk_feats, _) = load(chunk_name)
+                feats.append(chunk_feats)
+                num_feats += len(chunk_feats)
+                if num_feats >= FLAGS.num_train:
+                    break
+
+            feats = np.concatenate(feats)
+            feats = feats[np.random.RandomState(0).permutation(len(feats))[:FLAGS.num_train]]
+            print('Training on {:d} vectors'.format(len(feats)))
+            index.train(feats)
+
+    # rows past the last listed chunk are from an interrupted run, and are dropped before adding again
+    chunks_path = os.path.join(FLAGS.index_dir, CHUNKS_FILE_NAME)
+    paths_path = os.path.join(FLAGS.index_dir, PATHS_FILE_NAME)
+    chunks = read_chunks(chunks_path)
+    num_rows = chunks[-1][1] if chunks else 0
+    if len(index) != num_rows:
+        print('Dropping {:d} rows of an interrupted run'.format(len(index) - num_rows))
+    index.truncate(num_rows)
+    truncate_lines(paths_path, num_rows)
+    truncate_lines(chunks_path, len(chunks))
+
+    indexed_chunk_names = set(chunk_name for (chunk_name, _) in chunks)
+    for chunk_name in chunk_names:
+        if chunk_name in indexed_chunk_names:
+            continue
+
+        (feats, paths) = load(chunk_name)
+        index.add(feats)
+        with open(paths_path, 'a') as f:
+            f.writelines(path + '\n' for path in paths)
+        with open(chunks_path, 'a') as f:
+            f.write('{:s} {:d}\n'.format(chunk_name, len(index)))
+
+        print('Indexed {:s}, {:d} vectors in total'.format(chunk_name, len(index)))
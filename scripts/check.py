@@ -3,13 +3,14 @@
 import gflags
 import os
 import sys
-import tensorflow as tf
 
-from slender.model import Task, BatchFactory
+from slender.manifest import walk, walk_subdirs
+from slender.factory import Task, BatchFactory, Quarantine
 
 gflags.DEFINE_string('image_dir', None, 'Image directory')
 gflags.DEFINE_integer('batch_size', 64, 'Batch size')
 gflags.DEFINE_integer('num_parallels', 8, 'Number of parallel operations')
+gflags.DEFINE_integer('num_scanners', 16, 'Number of parallel directory scanners')
 
 gflags.MarkFlagsAsRequired(['image_dir'])
 FLAGS = gflags.FLAGS
@@ -22,6 +23,7 @@ class Factory(BatchFactory):
 
         super(Factory, self).__init__(
             batch_size=batch_size,
+            quarantine=Quarantine(key_fn=Quarantine.KeyFunction.IDENTITY()),
         )
 
         self.file_names = tf.placeholder(tf.string, shape=(None,))
@@ -54,44 +56,53 @@ class Factory(BatchFactory):
 if __name__ == '__main__':
     FLAGS(sys.argv)
 
+    import tensorflow as tf
+
     factory = Factory(
         batch_size=FLAGS.batch_size,
         num_parallels=FLAGS.num_parallels,
     )
 
-    all_file_paths = []
-    subdir_names = os.listdir(FLAGS.image_dir)
-    num_subdirs = len(subdir_names)
-    for (num_subdir, subdir_name) in enumerate(subdir_names):
-        subdir_path = os.path.join(FLAGS.image_dir, subdir_name)
-
-        for (file_dir, _, file_names) in os.walk(subdir_path, followlinks=True):
-            num_files = len(file_names)
-            sys.stderr.write('Checking subdir {:s} ({:d}/{:d}), filedir {:s}, {:d} files\n'.format(
-                subdir_name,
-                num_subdir + 1,
-                num_subdirs,
-                file_dir,
-                num_files,
-            ))
-
-            for (num_file, file_name) in enumerate(file_names):
-                file_path = os.path.join(file_dir, file_name)
-                all_file_paths.append(file_path)
-
-        while len(all_file_paths) > FLAGS.batch_size or num_subdir == num_subdirs - 1:
-            num_file_paths = min(FLAGS.batch_size, len(all_file_paths))
-
-            file_paths = all_file_paths[:num_file_paths]
-            del all_file_paths[:num_file_paths]
-
-            task = Task(inputs=file_paths)
-            valids = task.eval(factory=factory)
-            for (file_path, valid) in zip(file_paths, valids):
+    def list_files(subdir_path):
+        return [
+            os.path.join(file_dir, file_name)
+            for (file_dir, _, file_names) in walk(subdir_path, followlinks=True)
+            for file_name in file_names
+        ]
+
+    num_subdirs = len([
+        subdir_name
+        for subdir_name in os.listdir(FLAGS.image_dir)
+        if not subdir_name.startswith('.')
+        if os.path.isdir(os.path.join(FLAGS.image_dir, subdir_name))
+    ])
+    subdir_file_paths = walk_subdirs(FLAGS.image_dir, list_files, num_threads=FLAGS.num_scanners)
+
+    # both files that raised (and were quarantined) and files decoded to the wrong shape are removed
+    num_removed = 0
+    for (num_subdir, (subdir_name, file_paths)) in enumerate(subdir_file_paths):
+        sys.stderr.write('Checking subdir {:s} ({:d}/{:d}), {:d} files\n'.format(
+            subdir_name,
+            num_subdir + 1,
+            num_subdirs,
+            len(file_paths),
+        ))
+
+        tasks = []
+        for num_file_path in xrange(0, len(file_paths), FLAGS.batch_size):
+            task = Task(inputs=file_paths[num_file_path:num_file_path + FLAGS.batch_size])
+            task.eval(factory=factory, block=False)
+            tasks.append(task)
+
+        for task in tasks:
+            valids = task.join()
+            for (file_path, valid) in zip(task.inputs, valids):
                 if valid is None or not valid:
                     sys.stderr.write('Exception raised on {:s}\n'.format(file_path))
                     os.remove(file_path)
+                    num_removed += 1
 
         sys.stderr.write('\n')
 
+    sys.stderr.write('{:d} files failed to decode and were removed\n'.format(num_removed))
     factory.stop()
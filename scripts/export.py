@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import gflags
+import sys
+
+gflags.DEFINE_string('working_dir_root', None, 'Root working directory')
+gflags.DEFINE_string('export_dir', None, 'Directory to write the frozen graph to')
+gflags.DEFINE_bool('fold_batch_norm', True, 'Fold batch norm into conv weights')
+gflags.DEFINE_string('precision', 'float32', 'One of "float32", "float16" or "int8"')
+gflags.DEFINE_float('gpu_frac', 1.0, 'Fraction of GPU used')
+
+gflags.MarkFlagsAsRequired(['working_dir_root', 'export_dir'])
+FLAGS = gflags.FLAGS
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    from slender.producer import PlaceholderProducer as Producer
+    from slender.processor import TestProcessor as Processor
+    from slender.net import ClassifyNet, OnlineScheme
+    from slender.util import latest_working_dir
+
+    class Net(ClassifyNet, OnlineScheme):
+        pass
+
+    working_dir = latest_working_dir(FLAGS.working_dir_root)
+    producer = Producer(
+        working_dir=working_dir,
+    )
+    processor = Processor()
+    net = Net(
+        working_dir=working_dir,
+        num_classes=producer.num_classes,
+        fold_batch_norm=FLAGS.fold_batch_norm,
+        precision=FLAGS.precision,
+        gpu_frac=FLAGS.gpu_frac,
+    )
+    blob = (
+        producer.blob()
+        .f(processor.preprocess)
+        .f(net.build)
+        .f(processor.postprocess)
+    )
+    net.run()
+    net.export(
+        FLAGS.export_dir,
+        inputs={
+            'file_names': producer.file_names,
+            'contents': producer.contents,
+        },
+        outputs=blob,
+        class_names=producer.class_names,
+    )
+    print('Exported {:s} to {:s}'.format(net.restored_ckpt_path, FLAGS.export_dir))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import gflags
+import sys
+
+gflags.DEFINE_string('image_dir', None, 'Image directory')
+gflags.DEFINE_string('format', 'record', 'One of "record" (JPEG record files) or "store" (memory-mapped uint8 images)')
+gflags.DEFINE_string('record_dir', None, 'Record file or image store directory')
+gflags.DEFINE_integer('num_shards', 256, 'Number of record file shards')
+gflags.DEFINE_integer('shorter_dim', None, 'Maximum shorter side of stored images, by default the largest TrainProcessor resizes to; larger keeps detail under aspect stretch at the cost of store size')
+gflags.DEFINE_integer('subsample_ratio', 1, 'Image subsample')
+
+gflags.MarkFlagsAsRequired(['image_dir', 'record_dir'])
+FLAGS = gflags.FLAGS
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    from slender.producer import ImageNetFileProducer, RecordFileProducer, ImageStoreProducer
+
+    if FLAGS.subsample_ratio > 1:
+        subsample_fn = ImageNetFileProducer.SubsampleFunction.Hash(mod=FLAGS.subsample_ratio, divisible=False)
+    else:
+        subsample_fn = ImageNetFileProducer.SubsampleFunction.NoSubsample()
+
+    if FLAGS.format == 'record':
+        RecordFileProducer.pack(
+            image_dir=FLAGS.image_dir,
+            record_dir=FLAGS.record_dir,
+            num_shards=FLAGS.num_shards,
+            subsample_fn=subsample_fn,
+        )
+    elif FLAGS.format == 'store':
+        ImageStoreProducer.pack(
+            image_dir=FLAGS.image_dir,
+            store_dir=FLAGS.record_dir,
+            shorter_dim=FLAGS.shorter_dim,
+            subsample_fn=subsample_fn,
+        )
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import gflags
+import numpy as np
+import os
+import sys
+import threading
+import Queue
+
+gflags.DEFINE_string('image_dir', None, 'Image directory to score, walked recursively')
+gflags.DEFINE_string('manifest_path', None, 'Manifest of the image directory, reused and refreshed if given')
+gflags.DEFINE_string('file_list', None, 'Text file of image paths, one per line, instead of --image_dir')
+gflags.DEFINE_string('working_dir_root', None, 'Root working directory of the model')
+gflags.DEFINE_string('output_dir', None, 'Directory to write chunks of scores to')
+gflags.DEFINE_integer('batch_size', 64, 'Batch size')
+gflags.DEFINE_integer('chunk_size', 8192, 'Images per output chunk')
+gflags.DEFINE_integer('top_k', 5, 'Top labels to keep per image')
+gflags.DEFINE_bool('save_feats', False, 'Also write feats_2048')
+gflags.DEFINE_integer('num_readers', 8, 'Threads reading files ahead of the net')
+gflags.DEFINE_integer('num_prefetch', 4, 'Batches read ahead of the net')
+gflags.DEFINE_integer('num_scanners', 16, 'Number of parallel directory scanners')
+gflags.DEFINE_float('gpu_frac', 1.0, 'Fraction of GPU used')
+
+gflags.MarkFlagsAsRequired(['working_dir_root', 'output_dir'])
+FLAGS = gflags.FLAGS
+
+# the ordered list of files is frozen on the first run, so chunk numbers mean the same files on resume
+FILE_LIST_NAME = 'files.txt'
+
+# a chunk is complete once its path list exists, it is written last
+CHUNK_FILE_NAME = 'chunk-{:06d}.{:s}'
+
+
+def chunk_path(num_chunk, suffix):
+    return os.path.join(FLAGS.output_dir, CHUNK_FILE_NAME.format(num_chunk, suffix))
+
+
+def read(file_name):
+    try:
+        with open(file_name, 'rb') as f:
+            return f.read()
+    except IOError:
+        return ''
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.rstrip('\n')]
+
+
+def write_lines(path, lines):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(line + '\n' for line in lines)
+    os.rename(tmp_path, path)
+
+
+def list_files():
+    if FLAGS.file_list is not None:
+        return read_lines(FLAGS.file_list)
+
+    from slender.manifest import Manifest
+
+    manifest = Manifest(
+        FLAGS.image_dir,
+        manifest_path=FLAGS.manifest_path,
+        working_dir=FLAGS.output_dir,
+    ).load().update(num_threads=FLAGS.num_scanners).save()
+
+    # the manifest covers subdirs only, images lying directly in the directory are listed here
+    file_names = sorted([
+        os.path.join(FLAGS.image_dir, file_name)
+        for file_name in os.listdir(FLAGS.image_dir)
+        if not file_name.startswith('.')
+        if file_name.endswith('.jpg')
+        if os.path.isfile(os.path.join(FLAGS.image_dir, file_name))
+    ])
+    for subdir_name in sorted(manifest.entries.keys()):
+        file_names.extend(manifest.file_paths(subdir_name))
+
+    return file_names
+
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    import tensorflow as tf
+
+    from multiprocessing.pool import ThreadPool
+
+    from slender.producer import PlaceholderProducer as Producer
+    from slender.processor import TestProcessor as Processor
+    from slender.net import ClassifyNet, OnlineScheme
+    from slender.util import latest_working_dir
+
+    class Net(ClassifyNet, OnlineScheme):
+        pass
+
+    if not os.path.isdir(FLAGS.output_dir):
+        os.makedirs(FLAGS.output_dir)
+
+    if (FLAGS.image_dir is None) == (FLAGS.file_list is None):
+        sys.exit('Exactly one of --image_dir or --file_list is needed')
+
+    file_list_path = os.path.join(FLAGS.output_dir, FILE_LIST_NAME)
+    if not os.path.isfile(file_list_path):
+        write_lines(file_list_path, list_files())
+    file_names = np.array(read_lines(file_list_path), dtype=np.object)
+    num_chunks = (len(file_names) + FLAGS.chunk_size - 1) // FLAGS.chunk_size
+
+    def is_done(num_chunk):
+        path = chunk_path(num_chunk, 'paths.txt')
+        if not os.path.isfile(path):
+            return False
+
+        # e.g. a different --chunk_size than the run that wrote it
+        if read_lines(path) != list(file_names[num_chunk * FLAGS.chunk_size:(num_chunk + 1) * FLAGS.chunk_size]):
+            print('Chunk {:d} does not match {:s}, rescoring'.format(num_chunk, FILE_LIST_NAME))
+            return False
+
+        return True
+
+    num_chunks_to_run = [
+        num_chunk
+        for num_chunk in xrange(num_chunks)
+        if not is_done(num_chunk)
+    ]
+    print('{:d} files in {:d} chunks, {:d} to score'.format(len(file_names), num_chunks, len(num_chunks_to_run)))
+
+    working_dir = latest_working_dir(FLAGS.working_dir_root)
+    producer = Producer(
+        working_dir=working_dir,
+        batch_size=FLAGS.batch_size,
+    )
+    processor = Processor(
+        batch_size=FLAGS.batch_size,
+    )
+    net = Net(
+        working_dir=working_dir,
+        num_classes=producer.num_classes,
+        output_attrs=['predictions', 'feats_2048'] if FLAGS.save_feats else ['predictions'],
+        gpu_frac=FLAGS.gpu_frac,
+    )
+    blob = (
+        producer.blob()
+        .f(processor.preprocess)
+        .f(net.build)
+        .f(processor.postprocess)
+    )
+    net.run()
+
+    np.savetxt(os.path.join(FLAGS.output_dir, 'class_names.txt'), producer.class_names, fmt='%s')
+
+    # file contents are read on a thread pool, at most num_prefetch batches ahead of the net
+    batch_queue = Queue.Queue(maxsize=FLAGS.num_prefetch)
+
+    def produce():
+        pool = ThreadPool(FLAGS.num_readers)
+        for num_chunk in num_chunks_to_run:
+            chunk_file_names = file_names[num_chunk * FLAGS.chunk_size:(num_chunk + 1) * FLAGS.chunk_size]
+            for offset in xrange(0, len(chunk_file_names), FLAGS.batch_size):
+                batch_file_names = chunk_file_names[offset:offset + FLAGS.batch_size]
+                batch_queue.put((num_chunk, offset, batch_file_names, pool.map(read, batch_file_names)))
+        batch_queue.put(None)
+        pool.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    def score(contents):
+        return net.sess.run(blob, feed_dict={producer.contents: contents})
+
+    outputs = None
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            break
+
+        (num_chunk, offset, batch_file_names, contents) = item
+        if offset == 0:
+            chunk_file_names = file_names[num_chunk * FLAGS.chunk_size:(num_chunk + 1) * FLAGS.chunk_size]
+            outputs = {
+                'predictions': np.full((len(chunk_file_names), producer.num_classes), np.nan, dtype=np.float32),
+            }
+            if FLAGS.save_feats:
+                outputs['feats_2048'] = np.full((len(chunk_file_names), 2048), np.nan, dtype=np.float16)
+
+        # rows of undecodable images are left as nan
+        try:
+            output = score(contents)
+            for (key, value) in output.items():
+                outputs[key][offset:offset + len(contents)] = value
+        except tf.errors.OpError:
+            for (num_content, content) in enumerate(contents):
+                try:
+                    output = score([content])
+                except tf.errors.OpError:
+                    sys.stderr.write('Exception raised on {:s}\n'.format(batch_file_names[num_content]))
+                    continue
+
+                for (key, value) in output.items():
+                    outputs[key][offset + num_content] = value[0]
+
+        if offset + len(contents) < len(chunk_file_names):
+            continue
+
+        top_k = np.argsort(-np.nan_to_num(outputs['predictions']), axis=1)[:, :FLAGS.top_k]
+        outputs['top_k'] = np.where(np.isnan(outputs['predictions'][:, :1]), -1, top_k)
+
+        for (key, value) in outputs.items():
+            np.save(chunk_path(num_chunk, key + '.npy'), value)
+
+        write_lines(chunk_path(num_chunk, 'paths.txt'), chunk_file_names)
+
+        print('Scored chunk {:d}/{:d}'.format(num_chunk + 1, num_chunks))
+        outputs = None
@@ -8,12 +8,13 @@ gflags.DEFINE_string('working_dir_root', None, 'Root working directory')
 gflags.DEFINE_integer('batch_size', 16, 'Batch size')
 gflags.DEFINE_integer('subsample_ratio', 64, 'Training image subsample')
 gflags.DEFINE_float('gpu_frac', 1.0, 'Fraction of GPU used')
+gflags.DEFINE_string('tensor_cache_dir', None, 'Directory caching preprocessed images, unset to disable')
 FLAGS = gflags.FLAGS
 
 if __name__ == '__main__':
     argv = FLAGS(sys.argv)
 
-    from slender.producer import LocalFileProducer as Producer
+    from slender.producer import LocalFileProducer as Producer, TensorCacheProducer
     from slender.processor import TestProcessor as Processor
     from slender.net import ClassifyNet, TestScheme
     from slender.util import latest_working_dir
@@ -22,16 +23,26 @@ if __name__ == '__main__':
         pass
 
     working_dir = latest_working_dir(FLAGS.working_dir_root)
-    producer = Producer(
-        image_dir=FLAGS.image_dir,
-        working_dir=working_dir,
-        batch_size=FLAGS.batch_size,
-        subsample_fn=Producer.SubsampleFunction.Hash(mod=FLAGS.subsample_ratio, divisible=True),
-        mix_scheme=Producer.MixScheme.NoScheme,
-    )
     processor = Processor(
         batch_size=FLAGS.batch_size,
     )
+    if FLAGS.tensor_cache_dir is None:
+        producer = Producer(
+            image_dir=FLAGS.image_dir,
+            working_dir=working_dir,
+            batch_size=FLAGS.batch_size,
+            subsample_fn=Producer.SubsampleFunction.Hash(mod=FLAGS.subsample_ratio, divisible=True),
+            mix_scheme=Producer.MixScheme.NoScheme,
+        )
+    else:
+        producer = TensorCacheProducer(
+            processor=processor,
+            image_dir=FLAGS.image_dir,
+            working_dir=working_dir,
+            batch_size=FLAGS.batch_size,
+            subsample_fn=Producer.SubsampleFunction.Hash(mod=FLAGS.subsample_ratio, divisible=True),
+            cache_dir=FLAGS.tensor_cache_dir,
+        )
     net = Net(
         working_dir=working_dir,
         num_classes=producer.num_classes,
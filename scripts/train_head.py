@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import gflags
+import os
+import sys
+
+gflags.DEFINE_string('image_dir', None, 'Image directory, one subdir per class of the new menu')
+gflags.DEFINE_string('source_working_dir_root', None, 'Root working directory of the model lending its backbone')
+gflags.DEFINE_string('working_dir_root', None, 'Root working directory')
+gflags.DEFINE_string('store_dir', None, 'Feature store directory, extracted on first use')
+gflags.DEFINE_integer('batch_size', 256, 'Batch size')
+gflags.DEFINE_integer('extract_batch_size', 64, 'Batch size when extracting features')
+gflags.DEFINE_float('num_epochs', 30, 'Run epoch count')
+gflags.DEFINE_float('learning_rate', 1.0, 'Learning rate')
+gflags.DEFINE_float('learning_rate_decay_epoch', 10, 'Learning rate decay epoch count')
+gflags.DEFINE_float('learning_rate_decay_rate', 0.5, 'Learning rate decay rate')
+gflags.DEFINE_bool('use_bottleneck', False, 'Train a 64-dim bottleneck before the logits')
+gflags.DEFINE_float('gpu_frac', 1.0, 'Fraction of GPU used')
+
+gflags.MarkFlagsAsRequired(['working_dir_root', 'store_dir'])
+FLAGS = gflags.FLAGS
+
+if __name__ == '__main__':
+    argv = FLAGS(sys.argv)
+
+    import tensorflow as tf
+
+    from slender.blob import Blob
+    from slender.producer import FeatureProducer as Producer
+    from slender.net import BaseNet, ClassifyNet, TrainScheme, OnlineScheme
+    from slender.util import latest_working_dir, new_working_dir
+
+    if not os.path.isfile(os.path.join(FLAGS.store_dir, Producer.FeatsFileName)):
+        Producer.pack(
+            image_dir=FLAGS.image_dir,
+            store_dir=FLAGS.store_dir,
+            source_working_dir=latest_working_dir(FLAGS.source_working_dir_root),
+            batch_size=FLAGS.extract_batch_size,
+        )
+
+    working_dir = new_working_dir(FLAGS.working_dir_root)
+
+    with tf.Graph().as_default():
+        class Net(ClassifyNet, TrainScheme):
+            pass
+
+        producer = Producer(
+            working_dir=working_dir,
+            store_dir=FLAGS.store_dir,
+            batch_size=FLAGS.batch_size,
+        )
+        net = Net(
+            working_dir=working_dir,
+            num_classes=producer.num_classes,
+            use_bottleneck=FLAGS.use_bottleneck,
+            learning_rate=FLAGS.learning_rate,
+            learning_rate_decay_steps=FLAGS.learning_rate_decay_epoch * producer.num_batches_per_epoch,
+            learning_rate_decay_rate=FLAGS.learning_rate_decay_rate,
+            gpu_frac=FLAGS.gpu_frac,
+        )
+        blob = (
+            producer.blob()
+            .f(net.build)
+        )
+
+        net.run(int(FLAGS.num_epochs * producer.num_batches_per_epoch))
+
+    # the head is grafted back onto the backbone it was trained on, as a checkpoint OnlineScheme picks up
+    with tf.Graph().as_default():
+        class Net(ClassifyNet, OnlineScheme):
+            pass
+
+        net = Net(
+            working_dir=working_dir,
+            num_classes=producer.num_classes,
+            use_bottleneck=FLAGS.use_bottleneck,
+        )
+        net.forward(Blob(
+            images=tf.placeholder(tf.float32, shape=(None, None, None, 3)),
+            labels=tf.placeholder(tf.int64, shape=(None,)),
+        ))
+
+        train_dir = TrainScheme.get_working_dir(working_dir)
+        head_ckpt_path = tf.train.latest_checkpoint(train_dir)
+        ckpt_path = BaseNet.merge_checkpoints(
+            [producer.ckpt_path, head_ckpt_path],
+            os.path.join(train_dir, 'full.ckpt'),
+            global_step=int(head_ckpt_path.rsplit('-', 1)[1]),
+        )
+
+    print('Exported {:s}'.format(ckpt_path))
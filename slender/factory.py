@@ -1,18 +1,46 @@
 import abc
+import collections
+import cPickle as pickle
+import hashlib
+import inspect
+import itertools
+import math
+import os
 import threading
+import time
 import Queue
 
+try:
+    from concurrent.futures import Future
+except ImportError:
+    Future = None
+
+
+# event loop support is only imported once a loop is handed in, it is slow to import
+def _import_asyncio():
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio
+
 
 class Task(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, inputs, task_id=None):
+    def __init__(self, inputs, task_id=None, priority=0, deadline=None):
         self.inputs = inputs
-        self.outputs = []
+        self.outputs = [None] * len(inputs)
         self.task_id = task_id or id(self)
+        self.priority = priority  # lower is served first
+        self.deadline = deadline  # absolute time.time(), inputs not started by then are dropped
         self.size = 0
+        self.time = None
         self._event = threading.Event()
+        self._lock = threading.Lock()
         self._offset = 0
+        self._num_outputs = 0
+        self._callbacks = []
 
     def request_inputs(self, size):
         self.size = min(size, len(self.inputs) - self._offset)
@@ -20,15 +48,46 @@ class Task(object):
         self._offset += self.size
         return inputs
 
-    def is_done(self):
-        flag = (self._offset == len(self.inputs))
+    def is_requested(self):
+        return self._offset == len(self.inputs)
+
+    def num_remaining(self):
+        return len(self.inputs) - self._offset
+
+    def is_expired(self, now=None):
+        return (self.deadline is not None) and ((now or time.time()) > self.deadline)
+
+    def expire(self):
+        offset = self._offset
+        self._offset = len(self.inputs)
+        return self.set_outputs(offset, [None] * (len(self.inputs) - offset))
+
+    def set_outputs(self, offset, outputs):
+        with self._lock:
+            self.outputs[offset:offset + len(outputs)] = outputs
+            self._num_outputs += len(outputs)
+            flag = (self._num_outputs == len(self.inputs))
+
         if flag:
             self._event.set()
+            for callback in self._callbacks:
+                callback(self)
         return flag
 
+    def is_done(self):
+        return self._event.is_set()
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
     def eval(self, factory, block=True):
         if self.inputs:
-            factory.queue.put(self)
+            factory.put(self)
             if block:
                 self._event.wait()
                 return self.outputs
@@ -42,36 +101,323 @@ class Task(object):
         return self.outputs
 
 
+class Rejected(Queue.Full):
+    pass
+
+
+class KeyFunction(object):
+    @staticmethod
+    def IDENTITY():
+        def key_fn(input_):
+            return input_
+        return key_fn
+
+    @staticmethod
+    def HASH():
+        def key_fn(input_):
+            return hashlib.sha1(input_).hexdigest()
+        return key_fn
+
+    @staticmethod
+    def FILE_HASH(block_size=1 << 20):
+        # for path inputs, so that a file rewritten in place is not served its old result
+        def key_fn(input_):
+            sha1 = hashlib.sha1()
+            try:
+                with open(input_, 'rb') as f:
+                    for block in iter(lambda: f.read(block_size), ''):
+                        sha1.update(block)
+            except IOError:
+                return 'unreadable:{}'.format(input_)  # left to fail in run_one, None outputs are never cached
+            return sha1.hexdigest()
+        return key_fn
+
+
+class Quarantine(object):
+    MAX_SIZE = 65536
+    KeyFunction = KeyFunction
+
+    def __init__(self,
+                 key_fn=KeyFunction.IDENTITY(),
+                 max_size=MAX_SIZE):
+
+        self.key_fn = key_fn
+        self.max_size = max_size
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, input_):
+        with self._lock:
+            return self.key_fn(input_) in self._keys
+
+    def add(self, input_):
+        with self._lock:
+            self._keys[self.key_fn(input_)] = True
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def keys(self):
+        with self._lock:
+            return self._keys.keys()
+
+
+class ResultCache(object):
+    MAX_SIZE = 65536
+    KeyFunction = KeyFunction
+
+    def __init__(self,
+                 version=None,
+                 key_fn=KeyFunction.HASH(),
+                 max_size=MAX_SIZE,
+                 ttl=None,
+                 cache_dir=None):
+
+        self.version = version  # e.g. checkpoint path, entries of other versions are never hit
+        self.key_fn = key_fn
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, input_):
+        return hashlib.sha1('{}:{}'.format(self.version, self.key_fn(input_))).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _is_fresh(self, entry_time):
+        return (self.ttl is None) or (time.time() - entry_time < self.ttl)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if (entry is not None) and self._is_fresh(entry[0]):
+                self._entries[key] = entry
+                return (True, entry[1])
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            try:
+                entry_time = os.path.getmtime(path)
+                if self._is_fresh(entry_time):
+                    with open(path, 'rb') as f:
+                        output = pickle.load(f)
+
+                    self._set(key, output, entry_time=entry_time, to_disk=False)
+                    return (True, output)
+            except Exception:
+                pass
+
+        return (False, None)
+
+    def _set(self, key, output, entry_time=None, to_disk=True):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (entry_time or time.time(), output)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        # write-then-rename, so that other serving processes never read partial entries
+        if to_disk and (self.cache_dir is not None):
+            path = self._path(key)
+            tmp_path = '{:s}.{:d}.{:d}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                pass
+
+    def get(self, input_):
+        (hit, output) = self._get(self._key(input_))
+        with self._lock:
+            if hit:
+                self.num_hits += 1
+            else:
+                self.num_misses += 1
+        return (hit, output)
+
+    def set(self, input_, output):
+        self._set(self._key(input_), output)
+
+    def stats(self):
+        num_lookups = self.num_hits + self.num_misses
+        return {
+            'size': len(self._entries),
+            'num_hits': self.num_hits,
+            'num_misses': self.num_misses,
+            'hit_rate': (float(self.num_hits) / num_lookups) if num_lookups else 0.0,
+        }
+
+
 class BatchFactory(threading.Thread):
     __metaclass__ = abc.ABCMeta
 
     SERVE_FOREVER = True
     QUEUE_SIZE = 1024
-    TIMEOUT = 0.001
+    TIMEOUT = 0.001  # idle poll interval for two-argument timeout functions, built-in ones block when idle
 
     class TimeoutFunction(object):
         @staticmethod
         def CONSTANT(offset):
-            def timeout_fn(size, batch_size):
+            def timeout_fn(size, batch_size, elapsed=0.0):
                 if size == 0:
-                    return BatchFactory.TIMEOUT
+                    return None
                 else:
                     return offset
             return timeout_fn
 
         @staticmethod
         def QUARDRATIC(offset, delta):
-            def timeout_fn(size, batch_size):
+            def timeout_fn(size, batch_size, elapsed=0.0):
                 if size == 0:
-                    return BatchFactory.TIMEOUT
+                    return None
                 else:
                     return offset + delta * (1 - ((batch_size - 2 * float(size)) / batch_size) ** 2)
             return timeout_fn
 
+        class ADAPTIVE(object):
+            def __init__(self,
+                         latency,
+                         max_batch_size=None,
+                         z_score=2.33,
+                         decay=0.05,
+                         window=1.0):
+
+                self.latency = latency
+                self.max_batch_size = max_batch_size
+                self.z_score = z_score
+                self.decay = decay
+                self.window = window
+
+                self._stats = [0.0] * 5  # decayed sums of w, x, y, xx, xy
+                self._variance = 0.0
+                self._count = 0.0
+                self._count_time = None
+                self._lock = threading.Lock()
+
+            def cost(self, size):
+                (sw, sx, sy, sxx, sxy) = self._stats
+                if sw == 0:
+                    return None
+
+                det = sw * sxx - sx * sx
+                if det > 1e-6 * sw * sxx:
+                    slope = (sw * sxy - sx * sy) / det
+                    intercept = (sy - slope * sx) / sw
+                    cost = intercept + slope * size
+                else:
+                    # only one batch size seen so far, assume cost proportional to size
+                    cost = sy / sx * size
+
+                return max(cost, 0.0) + self.z_score * math.sqrt(self._variance)
+
+            def rate(self, now=None):
+                if self._count_time is None:
+                    return 0.0
+
+                now = now or time.time()
+                return self._count * math.exp(-(now - self._count_time) / self.window) / self.window
+
+            def record_arrival(self, num_inputs, arrival_time):
+                with self._lock:
+                    if self._count_time is not None:
+                        self._count *= math.exp(-max(arrival_time - self._count_time, 0.0) / self.window)
+                    self._count += num_inputs
+                    self._count_time = arrival_time if self._count_time is None else max(arrival_time, self._count_time)
+
+            def record_run(self, size, interval):
+                with self._lock:
+                    (sw, sx, sy, sxx, sxy) = self._stats
+                    if sw > 0:
+                        prediction = self.cost(size) - self.z_score * math.sqrt(self._variance)
+                        self._variance = (1 - self.decay) * self._variance + self.decay * (interval - prediction) ** 2
+
+                    self._stats = [
+                        (1 - self.decay) * stat + value
+                        for (stat, value) in zip(self._stats, [1.0, size, interval, size * size, size * interval])
+                    ]
+
+            def __call__(self, size, batch_size, elapsed=0.0):
+                if size == 0:
+                    return None
+
+                target_size = min(self.max_batch_size or batch_size, batch_size)
+                if size >= target_size:
+                    return 0
+
+                cost = self.cost(target_size)
+                if cost is None:
+                    return 0
+
+                # wait as long as the oldest input still meets the latency budget, but only if more inputs are expected
+                slack = self.latency - elapsed - cost
+                rate = self.rate()
+                if (slack <= 0) or (rate * slack < 1):
+                    return 0
+
+                return min(slack, (target_size - size) / rate)
+
+    class Admission(object):
+        def __init__(self,
+                     max_queue_depth=None,
+                     max_wait=None,
+                     max_inputs=None,
+                     shed_priority=0,
+                     shed_ratio=0.5):
+
+            self.max_queue_depth = max_queue_depth
+            self.max_wait = max_wait
+            self.max_inputs = max_inputs
+            self.shed_priority = shed_priority
+            self.shed_ratio = shed_ratio
+
+        def utilization(self, load):
+            return max([0.0] + [
+                float(value) / limit
+                for (value, limit) in [
+                    (load['queue_depth'], self.max_queue_depth),
+                    (load['estimated_wait'], self.max_wait),
+                    (load['num_inputs'], self.max_inputs),
+                ]
+                if limit
+            ])
+
+        def admit(self, task, load):
+            # background tasks are shed well before the limits that apply to interactive ones
+            if task.priority > self.shed_priority:
+                return self.utilization(load) < self.shed_ratio
+            else:
+                return self.utilization(load) < 1.0
+
+    @staticmethod
+    def _takes_elapsed(timeout_fn):
+        # timeout functions written before elapsed was passed take (size, batch_size) only
+        fn = timeout_fn if (inspect.isfunction(timeout_fn) or inspect.ismethod(timeout_fn)) else getattr(timeout_fn, '__call__', None)
+        try:
+            argspec = inspect.getargspec(fn)
+        except TypeError:
+            return False
+
+        num_args = len(argspec.args) - (1 if inspect.ismethod(fn) else 0)
+        return (argspec.varargs is not None) or (num_args >= 3)
+
     def __init__(self,
                  batch_size,
                  queue_size=QUEUE_SIZE,
                  timeout_fn=TimeoutFunction.CONSTANT(offset=0),
+                 num_workers=1,
+                 quarantine=None,
+                 admission=None,
+                 cache=None,
                  debug=False):
 
         super(BatchFactory, self).__init__()
@@ -80,65 +426,292 @@ class BatchFactory(threading.Thread):
         self.tasks = []
         self.batch_size = batch_size
         self.queue = Queue.Queue(maxsize=queue_size)
+        self.batches = Queue.Queue(maxsize=num_workers)
         self.timeout_fn = timeout_fn
+        self._timeout_elapsed = BatchFactory._takes_elapsed(timeout_fn)
+        self.num_workers = num_workers
+        self.quarantine = quarantine
+        self.admission = admission
+        self.cache = cache
         self.debug = debug
 
+        self._num_inputs = 0
+        self._throughput = None
+        self._load_lock = threading.Lock()
+
     def stop(self):
         self._stop.set()
 
+        # wake up the serving thread if it is blocked on an empty queue
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+
+    def load(self):
+        with self._load_lock:
+            num_inputs = self._num_inputs
+            throughput = self._throughput
+
+        return {
+            'queue_depth': self.queue.qsize() + len(self.tasks),
+            'num_inputs': num_inputs,
+            'throughput': throughput or 0.0,
+            'estimated_wait': (float(num_inputs) / throughput) if throughput else 0.0,
+        }
+
+    def _finish_task(self, task):
+        with self._load_lock:
+            self._num_inputs -= len(task.inputs)
+
+    def _split_cached(self, task):
+        indices = []
+        for (index, input_) in enumerate(task.inputs):
+            (hit, output) = self.cache.get(input_)
+            if hit:
+                task.set_outputs(index, [output])
+            else:
+                indices.append(index)
+
+        if not indices:
+            return None
+
+        # only the misses are queued, their results are cached and copied back into the original task
+        def finish(miss_task):
+            for (index, input_, output) in zip(indices, miss_task.inputs, miss_task.outputs):
+                if output is not None:
+                    self.cache.set(input_, output)
+                task.set_outputs(index, [output])
+
+        miss_task = Task(
+            inputs=[task.inputs[index] for index in indices],
+            task_id=task.task_id,
+            priority=task.priority,
+            deadline=task.deadline,
+        )
+        miss_task.add_done_callback(finish)
+        return miss_task
+
+    def put(self, task, block=True):
+        if self.cache is not None:
+            task = self._split_cached(task)
+            if task is None:
+                return
+
+        if (self.admission is not None) and not self.admission.admit(task, self.load()):
+            raise Rejected('Task {} rejected by admission control'.format(task.task_id))
+
+        task.time = time.time()
+        task.add_done_callback(self._finish_task)
+        with self._load_lock:
+            self._num_inputs += len(task.inputs)
+
+        try:
+            self.queue.put(task, block=block)
+        except Queue.Full:
+            self._finish_task(task)
+            raise
+
+    def submit(self, inputs, task_id=None, priority=0, deadline=None, loop=None):
+        if Future is None:
+            raise ImportError('BatchFactory.submit requires concurrent.futures (pip install futures)')
+
+        # no thread waits on the task, the future is resolved from the worker thread
+        future = Future()
+        task = Task(inputs=inputs, task_id=task_id, priority=priority, deadline=deadline)
+        task.add_done_callback(lambda task: future.set_result(task.outputs))
+
+        if inputs:
+            try:
+                self.put(task, block=False)
+            except Queue.Full as e:
+                future.set_exception(e)
+        else:
+            future.set_result([])
+
+        if loop is None:
+            return future
+        else:
+            return _import_asyncio().wrap_future(future, loop=loop)
+
     @abc.abstractmethod
     def run_one(self, inputs):
         pass
 
-    def run(self):
-        while BatchFactory.SERVE_FOREVER:
-            inputs = []
+    def prefetch(self, inputs):  # runs on the assembling thread, while workers are busy with run_one
+        return inputs
 
-            # finish tasks at hand first ...
-            for task in self.tasks:
-                inputs.extend(task.request_inputs(size=self.batch_size - len(inputs)))
+    def _request_inputs(self, task, inputs, segments, size):
+        task_inputs = task.request_inputs(size=size)
+        if task.size == 0:
+            return
 
-            # ... before retrieving new tasks
-            while len(inputs) < self.batch_size:
-                if self._stop.is_set():
-                    return 0
+        segments.append((task, task._offset - task.size, task.size))
+        inputs.extend(task_inputs)
 
-                try:
-                    task = self.queue.get(timeout=self.timeout_fn(len(inputs), self.batch_size))
-                except Queue.Empty:
-                    break
-                else:
-                    self.tasks.append(task)
-                    inputs.extend(task.request_inputs(size=self.batch_size - len(inputs)))
+    def _accept_task(self, task):
+        if task is None:
+            self.queue.task_done()
+            return
 
-            if len(inputs) == 0:
-                continue
+        if isinstance(self.timeout_fn, BatchFactory.TimeoutFunction.ADAPTIVE):
+            self.timeout_fn.record_arrival(len(task.inputs), task.time)
+
+        self.tasks.append(task)
+
+    def _expire_tasks(self):
+        now = time.time()
+        for task in self.tasks:
+            if task.is_expired(now) and task.expire():
+                self.queue.task_done()
+
+        self.tasks = [task for task in self.tasks if not task.is_requested()]
 
+    def _schedule(self):
+        inputs = []
+        segments = []
+
+        # strict priority across levels, earliest deadline first within a level
+        tasks = sorted(self.tasks, key=lambda task: (
+            task.priority,
+            float('inf') if task.deadline is None else task.deadline,
+            task.time,
+        ))
+        for (_, level_tasks) in itertools.groupby(tasks, key=lambda task: task.priority):
+            level_tasks = list(level_tasks)
+
+            # every task of the level gets a fair share first, so a bulk task cannot starve small ones ...
+            quantum = max(1, (self.batch_size - len(inputs)) // len(level_tasks))
+            for task in level_tasks:
+                self._request_inputs(task, inputs, segments, size=min(quantum, self.batch_size - len(inputs)))
+
+            # ... and the leftover room goes in order
+            for task in level_tasks:
+                self._request_inputs(task, inputs, segments, size=self.batch_size - len(inputs))
+
+        # do not remove in-place, dangerous!
+        self.tasks = [task for task in self.tasks if not task.is_requested()]
+
+        return (segments, inputs)
+
+    def _run_bisect(self, inputs):
+        try:
+            start = time.time()
+            outputs = self.run_one(inputs)
+            if isinstance(self.timeout_fn, BatchFactory.TimeoutFunction.ADAPTIVE):
+                self.timeout_fn.record_run(len(inputs), time.time() - start)
+        # split in halves, so k bad inputs cost O(k log n) calls instead of n
+        except Exception as e:
+            if self.debug:
+                print(e)
+
+            if len(inputs) == 1:
+                if self.quarantine is not None:
+                    self.quarantine.add(inputs[0])
+                outputs = [None]
+            else:
+                half = len(inputs) // 2
+                # run_one may return arrays, where + would add element-wise
+                outputs = list(self._run_bisect(inputs[:half])) + list(self._run_bisect(inputs[half:]))
+
+        return outputs
+
+    def _run_batch(self, inputs):
+        if self.quarantine is None:
+            return self._run_bisect(inputs)
+
+        # known-bad inputs are answered without touching the model
+        indices = [index for (index, input_) in enumerate(inputs) if input_ not in self.quarantine]
+        outputs = [None] * len(inputs)
+        if indices:
+            for (index, output) in zip(indices, self._run_bisect([inputs[index] for index in indices])):
+                outputs[index] = output
+
+        return outputs
+
+    def _run_worker(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+
+            (segments, inputs) = batch
+            start = time.time()
+
+            # a failing worker would leave its tasks waiting forever, answer them instead
             try:
-                outputs = self.run_one(inputs)
-            # try one by one
+                outputs = list(self._run_batch(inputs))
             except Exception as e:
                 if self.debug:
                     print(e)
+                outputs = [None] * len(inputs)
 
-                outputs = []
-                for input_ in inputs:
-                    try:
-                        output = self.run_one([input_])[0]
-                    except Exception:
-                        output = None
+            throughput = self.num_workers * len(inputs) / max(time.time() - start, 1e-6)
+            with self._load_lock:
+                self._throughput = throughput if self._throughput is None else 0.9 * self._throughput + 0.1 * throughput
 
-                    outputs.append(output)
+            # segments remember where each slice goes, so batches may finish out of order
+            for (task, offset, size) in segments:
+                if task.set_outputs(offset, outputs[:size]):
+                    self.queue.task_done()
+                outputs = outputs[size:]
+
+    def run(self):
+        workers = [
+            threading.Thread(target=self._run_worker, name='{:s}-worker-{:d}'.format(self.name, num_worker))
+            for num_worker in xrange(self.num_workers)
+        ]
+        for worker in workers:
+            worker.daemon = self.daemon
+            worker.start()
 
-            # do not remove in-place, dangerous!
-            tasks_ = []
-            for task in self.tasks:
-                task.outputs.extend(outputs[:task.size])
-                outputs = outputs[task.size:]
+        try:
+            self._run_assembler()
+        finally:
+            for worker in workers:
+                self.batches.put(None)
+            for worker in workers:
+                worker.join()
 
-                if task.is_done():
-                    self.queue.task_done()
+        return 0
+
+    def _run_assembler(self):
+        while BatchFactory.SERVE_FOREVER:
+            # take in everything that has arrived, so that scheduling sees all candidates ...
+            while (self.queue.maxsize <= 0) or (len(self.tasks) < self.queue.maxsize):
+                try:
+                    task = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                else:
+                    self._accept_task(task)
+
+            # ... and wait for more while the batch is not full
+            while sum(task.num_remaining() for task in self.tasks) < self.batch_size:
+                if self._stop.is_set():
+                    return
+
+                size = sum(task.num_remaining() for task in self.tasks)
+                elapsed = (time.time() - min(task.time for task in self.tasks)) if self.tasks else 0.0
+                if self._timeout_elapsed:
+                    timeout = self.timeout_fn(size, self.batch_size, elapsed)
                 else:
-                    tasks_.append(task)
+                    timeout = self.timeout_fn(size, self.batch_size)
+
+                # a None timeout blocks until a task arrives, stop() wakes it with a sentinel
+                try:
+                    task = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                else:
+                    self._accept_task(task)
+
+            if self._stop.is_set():
+                return
+
+            self._expire_tasks()
+            (segments, inputs) = self._schedule()
+            if len(inputs) == 0:
+                continue
 
-            self.tasks = tasks_
+            self.batches.put((segments, self.prefetch(inputs)))
@@ -0,0 +1,87 @@
+import json
+import os
+import tensorflow as tf
+
+from .blob import Blob
+
+
+# serves a graph exported by `OnlineScheme.export`, without building the net in python
+class FrozenNet(object):
+    GraphFileName = 'graph.pb'
+    SignatureFileName = 'signature.json'
+
+    @staticmethod
+    def save(export_dir,
+             graph_def,
+             inputs,
+             outputs,
+             class_names=None,
+             ckpt_path=None):
+
+        if not os.path.isdir(export_dir):
+            os.makedirs(export_dir)
+
+        signature = {
+            'inputs': {key: tensor.name for (key, tensor) in inputs.items()},
+            'outputs': {key: tensor.name for (key, tensor) in outputs.items()},
+            'class_names': None if class_names is None else list(class_names),
+            'ckpt_path': ckpt_path,
+        }
+
+        # each file is renamed into place, and the signature goes last, so a present signature implies a complete graph
+        graph_path = os.path.join(export_dir, FrozenNet.GraphFileName)
+        with open(graph_path + '.tmp', 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        os.rename(graph_path + '.tmp', graph_path)
+
+        signature_path = os.path.join(export_dir, FrozenNet.SignatureFileName)
+        with open(signature_path + '.tmp', 'w') as f:
+            json.dump(signature, f, indent=4)
+        os.rename(signature_path + '.tmp', signature_path)
+
+    def __init__(self,
+                 export_dir,
+                 gpu_frac=1.0,
+                 log_device_placement=False):
+
+        with open(os.path.join(export_dir, FrozenNet.SignatureFileName), 'r') as f:
+            signature = json.load(f)
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, FrozenNet.GraphFileName), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.inputs = Blob(**{
+            str(key): self.graph.get_tensor_by_name(name)
+            for (key, name) in signature['inputs'].items()
+        })
+        self.blob = Blob(**{
+            str(key): self.graph.get_tensor_by_name(name)
+            for (key, name) in signature['outputs'].items()
+        })
+
+        self.class_names = signature['class_names']
+        if self.class_names is not None:
+            self.num_classes = len(self.class_names)
+        self.restored_ckpt_path = signature['ckpt_path']
+
+        self.session_config = tf.ConfigProto(
+            gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac),
+            log_device_placement=log_device_placement,
+        )
+
+    def run(self):
+        self.sess = tf.Session(
+            graph=self.graph,
+            config=self.session_config,
+        )
+
+    def feed_dict(self, **kwargs):
+        return {
+            self.inputs[key]: value
+            for (key, value) in kwargs.items()
+        }
@@ -0,0 +1,347 @@
+import numpy as np
+import os
+import threading
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _squared_distances(queries, vectors):
+    return (
+        np.sum(queries ** 2, axis=1)[:, None] -
+        2 * np.dot(queries, vectors.T) +
+        np.sum(vectors ** 2, axis=1)[None, :]
+    )
+
+
+def _top_k(distances, k):
+    k = min(k, distances.shape[1])
+    if k == 0:
+        return (distances[:, :0], np.zeros(distances[:, :0].shape, dtype=np.int64))
+
+    rows = np.arange(len(distances))[:, None]
+    indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    indices = indices[rows, np.argsort(distances[rows, indices], axis=1)]
+    return (distances[rows, indices], indices)
+
+
+def _pad(distances, indices, k):
+    num_missing = k - distances.shape[1]
+    if num_missing > 0:
+        distances = np.pad(distances, ((0, 0), (0, num_missing)), mode='constant', constant_values=np.inf)
+        indices = np.pad(indices, ((0, 0), (0, num_missing)), mode='constant', constant_values=-1)
+    return (distances, indices)
+
+
+def _lookup(ids, indices):
+    result = -np.ones_like(indices)
+    is_found = (indices >= 0)
+    result[is_found] = ids[indices[is_found]]
+    return result
+
+
+def _assign(vectors, centroids, batch_size=16384):
+    return np.concatenate([
+        np.argmin(_squared_distances(vectors[offset:offset + batch_size], centroids), axis=1)
+        for offset in xrange(0, len(vectors), batch_size)
+    ] or [np.zeros((0,), dtype=np.int64)])
+
+
+def _kmeans(vectors, num_clusters, num_iters=20, seed=0):
+    random_state = np.random.RandomState(seed)
+    centroids = vectors[random_state.choice(len(vectors), num_clusters, replace=len(vectors) < num_clusters)].copy()
+
+    for num_iter in xrange(num_iters):
+        assignments = _assign(vectors, centroids)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # empty clusters are reseeded on random points rather than left to die
+        is_empty = (counts == 0)
+        centroids[~is_empty] = sums[~is_empty] / counts[~is_empty, None]
+        centroids[is_empty] = vectors[random_state.choice(len(vectors), np.sum(is_empty))]
+
+    return centroids
+
+
+class Storage(object):
+    # rows appended to a flat file and memory-mapped back, or kept in memory without a path
+    def __init__(self, path, dtype, row_shape=()):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.array = np.zeros((0,) + self.row_shape, dtype=self.dtype)
+
+        if (path is not None) and os.path.isfile(path):
+            self._map()
+
+    def _map(self):
+        row_size = self.dtype.itemsize * int(np.prod(self.row_shape))
+        num_rows = os.path.getsize(self.path) // row_size
+        if num_rows > 0:
+            self.array = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(num_rows,) + self.row_shape)
+
+    def __len__(self):
+        return len(self.array)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        if self.path is None:
+            self.array = np.concatenate([self.array, rows])
+        else:
+            with open(self.path, 'ab') as f:
+                f.write(rows.tobytes())
+            self._map()
+
+    def truncate(self, num_rows):
+        if self.path is None:
+            self.array = self.array[:num_rows]
+        elif os.path.isfile(self.path):
+            # the map is dropped first, reading a truncated map faults
+            self.array = np.zeros((0,) + self.row_shape, dtype=self.dtype)
+            row_size = self.dtype.itemsize * int(np.prod(self.row_shape))
+            with open(self.path, 'r+b') as f:
+                f.truncate(num_rows * row_size)
+            self._map()
+
+
+class BaseIndex(object):
+    IdsFileName = 'ids.bin'
+
+    def __init__(self,
+                 dim,
+                 index_dir=None,
+                 normalize=False):
+
+        if (index_dir is not None) and (not os.path.isdir(index_dir)):
+            os.makedirs(index_dir)
+
+        self.dim = dim
+        self.index_dir = index_dir
+        self.normalize = normalize  # unit vectors, so that l2 ranks like cosine similarity
+        self.lock = threading.Lock()
+        self.ids = Storage(self._path(BaseIndex.IdsFileName), np.int64)
+
+    def _path(self, file_name):
+        if self.index_dir is None:
+            return None
+        return os.path.join(self.index_dir, file_name)
+
+    def _prepare(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape((-1, self.dim))
+        if self.normalize:
+            vectors = _normalize(vectors)
+        return vectors
+
+    def _next_ids(self, ids, num_vectors):
+        if ids is None:
+            return np.arange(len(self.ids), len(self.ids) + num_vectors, dtype=np.int64)
+        return np.asarray(ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def truncate(self, num_rows):  # drops rows past num_rows, e.g. those of an interrupted add
+        with self.lock:
+            self.ids.truncate(num_rows)
+
+    def add(self, vectors, ids=None):
+        pass
+
+    def search(self, queries, k=10):  # returns (squared distances, ids), padded with (inf, -1)
+        pass
+
+
+class BruteForceIndex(BaseIndex):
+    VectorsFileName = 'vectors.bin'
+
+    def __init__(self,
+                 dim,
+                 index_dir=None,
+                 normalize=False,
+                 batch_size=65536):
+
+        super(BruteForceIndex, self).__init__(
+            dim,
+            index_dir=index_dir,
+            normalize=normalize,
+        )
+
+        self.batch_size = batch_size
+        self.vectors = Storage(self._path(BruteForceIndex.VectorsFileName), np.float32, (dim,))
+
+    def truncate(self, num_rows):
+        super(BruteForceIndex, self).truncate(num_rows)
+        with self.lock:
+            self.vectors.truncate(num_rows)
+
+    def add(self, vectors, ids=None):
+        vectors = self._prepare(vectors)
+        with self.lock:
+            self.vectors.append(vectors)
+            self.ids.append(self._next_ids(ids, len(vectors)))
+
+    def search(self, queries, k=10):
+        queries = self._prepare(queries)
+
+        # a snapshot, so that inserts do not disturb a search in flight
+        (vectors, ids) = (self.vectors.array, self.ids.array)
+        num_vectors = min(len(vectors), len(ids))
+
+        distances = np.zeros((len(queries), 0), dtype=np.float32)
+        indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for offset in xrange(0, num_vectors, self.batch_size):
+            block = np.asarray(vectors[offset:min(offset + self.batch_size, num_vectors)])
+            (block_distances, block_indices) = _top_k(_squared_distances(queries, block), k)
+
+            # only the running top k survive each block, memory stays flat in the index size
+            distances = np.hstack([distances, block_distances])
+            indices = np.hstack([indices, block_indices + offset])
+            (distances, positions) = _top_k(distances, k)
+            indices = indices[np.arange(len(queries))[:, None], positions]
+
+        (distances, indices) = _pad(distances, indices, k)
+        return (distances, _lookup(ids, indices))
+
+
+class IVFPQIndex(BaseIndex):
+    ModelFileName = 'model.npz'
+    ListsFileName = 'lists.bin'
+    CodesFileName = 'codes.bin'
+    NumCodes = 256
+
+    def __init__(self,
+                 dim,
+                 index_dir=None,
+                 normalize=False,
+                 num_lists=1024,
+                 num_subspaces=16,
+                 num_probes=16):
+
+        assert dim % num_subspaces == 0
+
+        super(IVFPQIndex, self).__init__(
+            dim,
+            index_dir=index_dir,
+            normalize=normalize,
+        )
+
+        self.num_lists = num_lists
+        self.num_subspaces = num_subspaces
+        self.num_probes = num_probes
+
+        self.lists = Storage(self._path(IVFPQIndex.ListsFileName), np.int32)
+        self.codes = Storage(self._path(IVFPQIndex.CodesFileName), np.uint8, (num_subspaces,))
+        self.members = None
+
+        self.centroids = None
+        self.codebooks = None
+        model_path = self._path(IVFPQIndex.ModelFileName)
+        if (model_path is not None) and os.path.isfile(model_path):
+            model = np.load(model_path)
+            (self.centroids, self.codebooks) = (model['centroids'], model['codebooks'])
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _subspaces(self, vectors):
+        return np.split(vectors, self.num_subspaces, axis=1)
+
+    def train(self, vectors, num_iters=20, seed=0):
+        vectors = self._prepare(vectors)
+
+        centroids = _kmeans(vectors, self.num_lists, num_iters=num_iters, seed=seed)
+        residuals = vectors - centroids[_assign(vectors, centroids)]
+        codebooks = np.stack([
+            _kmeans(sub_residuals, IVFPQIndex.NumCodes, num_iters=num_iters, seed=seed)
+            for sub_residuals in self._subspaces(residuals)
+        ])
+
+        (self.centroids, self.codebooks) = (centroids, codebooks)
+        model_path = self._path(IVFPQIndex.ModelFileName)
+        if model_path is not None:
+            np.savez(model_path, centroids=centroids, codebooks=codebooks)
+
+        return self
+
+    def truncate(self, num_rows):
+        super(IVFPQIndex, self).truncate(num_rows)
+        with self.lock:
+            self.codes.truncate(num_rows)
+            self.lists.truncate(num_rows)
+            self.members = None
+
+    def add(self, vectors, ids=None):
+        assert self.is_trained()
+        vectors = self._prepare(vectors)
+
+        lists = _assign(vectors, self.centroids)
+        codes = np.stack([
+            _assign(sub_residuals, codebook)
+            for (sub_residuals, codebook) in zip(self._subspaces(vectors - self.centroids[lists]), self.codebooks)
+        ], axis=1)
+
+        with self.lock:
+            # lists go last, rows are only searched once their codes and ids exist
+            offset = len(self.codes)
+            self.ids.append(self._next_ids(ids, len(vectors)))
+            self.codes.append(codes)
+            self.lists.append(lists)
+
+            # inverted lists are extended in place, not rebuilt on every insert
+            if self.members is not None:
+                rows = np.arange(offset, offset + len(vectors))
+                for num_list in np.unique(lists):
+                    self.members[num_list] = np.concatenate([self.members[num_list], rows[lists == num_list]])
+
+    def _get_members(self):
+        with self.lock:
+            if self.members is None:
+                lists = np.asarray(self.lists.array)
+                order = np.argsort(lists, kind='mergesort')
+                bounds = np.searchsorted(lists[order], np.arange(1, self.num_lists))
+                self.members = np.split(order, bounds)
+
+            return list(self.members)
+
+    def search(self, queries, k=10, num_probes=None):
+        queries = self._prepare(queries)
+        members = self._get_members()
+        (codes, ids) = (self.codes.array, self.ids.array)
+
+        (_, probes) = _top_k(_squared_distances(queries, self.centroids), num_probes or self.num_probes)
+        subspace_indices = np.arange(self.num_subspaces)
+
+        all_distances = []
+        all_indices = []
+        for (query, query_probes) in zip(queries, probes):
+            distances = []
+            indices = []
+            for num_list in query_probes:
+                rows = members[num_list]
+                if len(rows) == 0:
+                    continue
+
+                # asymmetric distance: the exact query residual against every codeword, looked up per code
+                sub_residuals = np.split(query - self.centroids[num_list], self.num_subspaces)
+                tables = np.stack([
+                    np.sum((codebook - sub_residual[None, :]) ** 2, axis=1)
+                    for (sub_residual, codebook) in zip(sub_residuals, self.codebooks)
+                ])
+                distances.append(np.sum(tables[subspace_indices, np.asarray(codes[rows])], axis=1))
+                indices.append(rows)
+
+            distances = np.concatenate(distances or [np.zeros((0,), dtype=np.float32)])[None, :]
+            indices = np.concatenate(indices or [np.zeros((0,), dtype=np.int64)])[None, :]
+            (distances, positions) = _top_k(distances, k)
+            (distances, positions) = _pad(distances, positions, k)
+
+            all_distances.append(distances[0])
+            all_indices.append(_lookup(indices[0], positions[0]))
+
+        indices = np.array(all_indices, dtype=np.int64).reshape((len(queries), k))
+        distances = np.array(all_distances, dtype=np.float32).reshape((len(queries), k))
+        return (distances, _lookup(ids, indices))
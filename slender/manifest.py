@@ -0,0 +1,196 @@
+import cPickle as pickle
+import numpy as np
+import os
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from scandir import scandir, walk
+except ImportError:
+    from os import walk
+    try:
+        from os import scandir
+    except ImportError:
+        scandir = None
+
+
+def _list_dir(dir_path):
+    # yields (path, is_dir, stat_fn) per entry, scandir stats come with the listing on most platforms
+    if scandir is None:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            yield (path, os.path.isdir(path), lambda path=path: os.stat(path))
+    else:
+        for entry in scandir(dir_path):
+            yield (entry.path, entry.is_dir(), entry.stat)
+
+
+def walk_subdirs(image_dir, scan_fn, num_threads=16):
+    subdir_names = sorted([
+        subdir_name
+        for subdir_name in os.listdir(image_dir)
+        if not subdir_name.startswith('.')
+        if os.path.isdir(os.path.join(image_dir, subdir_name))
+    ])
+
+    def _scan_fn(subdir_name):
+        return (subdir_name, scan_fn(os.path.join(image_dir, subdir_name)))
+
+    pool = ThreadPool(num_threads)
+    try:
+        for (subdir_name, result) in pool.imap_unordered(_scan_fn, subdir_names):
+            yield (subdir_name, result)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Manifest(object):
+    FileName = '.manifest'
+    Version = 1
+    Keys = ['dir_mtimes', 'label', 'file_paths', 'sizes', 'mtimes']
+
+    @staticmethod
+    def _is_valid(entry):
+        if any(key not in entry for key in Manifest.Keys):
+            return False
+
+        for (dir_path, mtime) in entry['dir_mtimes'].items():
+            try:
+                if os.path.getmtime(dir_path) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    @staticmethod
+    def _scan(subdir_path):
+        dir_mtimes = {}
+        file_paths = []
+        sizes = []
+        mtimes = []
+
+        dir_paths = [subdir_path]
+        while dir_paths:
+            dir_path = dir_paths.pop()
+            dir_mtimes[dir_path] = os.path.getmtime(dir_path)
+
+            for (path, is_dir, stat_fn) in _list_dir(dir_path):
+                if is_dir:
+                    dir_paths.append(path)
+                    continue
+
+                file_name = os.path.basename(path)
+                if file_name.startswith('.'):
+                    continue
+                if not file_name.endswith('.jpg'):
+                    continue
+
+                stat = stat_fn()
+                file_paths.append(path)
+                sizes.append(stat.st_size)
+                mtimes.append(stat.st_mtime)
+
+        # walk order is filesystem dependent, keep the listing deterministic
+        indices = np.argsort(file_paths)
+        return {
+            'dir_mtimes': dir_mtimes,
+            'label': os.path.basename(subdir_path),  # the class name of every file in the entry
+            'file_paths': np.array(file_paths, dtype=np.object)[indices],
+            'sizes': np.array(sizes, dtype=np.int64)[indices],
+            'mtimes': np.array(mtimes, dtype=np.float64)[indices],
+        }
+
+    def __init__(self,
+                 image_dir,
+                 manifest_path=None,
+                 working_dir=None):
+
+        self.image_dir = image_dir
+        if manifest_path is None:
+            self.manifest_paths = [os.path.join(image_dir, Manifest.FileName)]
+            if working_dir is not None:
+                self.manifest_paths.append(os.path.join(working_dir, Manifest.FileName))
+        else:
+            self.manifest_paths = [manifest_path]
+
+        self.entries = {}
+        self.is_dirty = False
+
+    def load(self):
+        for manifest_path in self.manifest_paths:
+            if not os.path.isfile(manifest_path):
+                continue
+
+            try:
+                with open(manifest_path, 'rb') as f:
+                    manifest = pickle.load(f)
+            except Exception:
+                continue
+
+            if manifest.get('version') != Manifest.Version:
+                continue
+            if manifest.get('image_dir') != self.image_dir:
+                continue
+
+            self.entries = manifest['entries']
+            break
+
+        return self
+
+    def save(self):
+        if not self.is_dirty:
+            return self
+
+        manifest = {
+            'version': Manifest.Version,
+            'image_dir': self.image_dir,
+            'entries': self.entries,
+        }
+        for manifest_path in self.manifest_paths:
+            tmp_path = '{:s}.{:d}.tmp'.format(manifest_path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_path, manifest_path)
+            except (IOError, OSError):
+                continue
+            else:
+                self.is_dirty = False
+                break
+
+        return self
+
+    def update(self, num_threads=16):
+        entries = {}
+
+        # stale classes are re-scanned concurrently, since metadata latency dominates on remote storage
+        def refresh(subdir_path):
+            entry = self.entries.get(os.path.basename(subdir_path))
+            if (entry is not None) and Manifest._is_valid(entry):
+                return (entry, False)
+            return (Manifest._scan(subdir_path), True)
+
+        for (subdir_name, (entry, is_scanned)) in walk_subdirs(self.image_dir, refresh, num_threads=num_threads):
+            entries[subdir_name] = entry
+            if is_scanned:
+                self.is_dirty = True
+                print('Scanned subdir {:s} ({:d})'.format(subdir_name, len(entry['file_paths'])))
+
+        if set(entries.keys()) != set(self.entries.keys()):
+            self.is_dirty = True
+
+        self.entries = entries
+        return self
+
+    def file_paths(self, subdir_name):
+        return self.entries[subdir_name]['file_paths']
+
+    def label(self, subdir_name):
+        return self.entries[subdir_name]['label']
+
+    def sizes(self, subdir_name):
+        return self.entries[subdir_name]['sizes']
+
+    def mtimes(self, subdir_name):
+        return self.entries[subdir_name]['mtimes']
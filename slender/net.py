@@ -1,17 +1,50 @@
 # -*- encoding: utf-8 -*-
 
+import numpy as np
 import os
 import tensorflow as tf
+import threading
+import time
 import tensorflow.contrib.slim as slim
 
 from .blob import Blob
+from .frozen import FrozenNet
+from .processor import BaseProcessor
 from .util import scope_join_fn
 
 _ = scope_join_fn('net')
 
 
+class TrackedSession(object):
+    # counts runs in flight, so that a session swapped out by a reload is closed only once they finish
+    def __init__(self, sess):
+        self.sess = sess
+        self.num_runs = 0
+        self.condition = threading.Condition()
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
+
+    def run(self, *args, **kwargs):
+        with self.condition:
+            self.num_runs += 1
+        try:
+            return self.sess.run(*args, **kwargs)
+        finally:
+            with self.condition:
+                self.num_runs -= 1
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            while self.num_runs > 0:
+                self.condition.wait()
+        self.sess.close()
+
+
 class BaseNet(object):
     IsTraining = None  # set by scheme
+    IsInference = False  # set by scheme
 
     @staticmethod
     def get_scope_set(scopes=None, collection=tf.GraphKeys.GLOBAL_VARIABLES):
@@ -56,6 +89,32 @@ class BaseNet(object):
         self.prepare()
         return blob
 
+    def read_checkpoint(self, ckpt_path, var_list):
+        reader = tf.train.NewCheckpointReader(ckpt_path)
+        return [reader.get_tensor(var.op.name) for var in var_list]
+
+    @staticmethod
+    def merge_checkpoints(ckpt_paths, save_path, global_step=None):
+        # every variable of the graph is taken from the last checkpoint holding it
+        var_list = list(BaseNet.get_scope_set())
+        readers = map(tf.train.NewCheckpointReader, ckpt_paths)
+
+        assign_ops = []
+        assign_feed_dict = {}
+        for var in var_list:
+            values = [reader.get_tensor(var.op.name) for reader in readers if reader.has_tensor(var.op.name)]
+            if not values:
+                raise ValueError('Variable {:s} not found in {}'.format(var.op.name, ckpt_paths))
+
+            placeholder = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+            assign_ops.append(var.assign(placeholder))
+            assign_feed_dict[placeholder] = values[-1]
+
+        saver = tf.train.Saver(var_list=var_list, save_relative_paths=True)
+        with tf.Session() as sess:
+            sess.run(tf.group(*assign_ops), feed_dict=assign_feed_dict)
+            return saver.save(sess, save_path, global_step=global_step)
+
     def forward(self, blob):  # implemented by net
         pass
 
@@ -83,6 +142,36 @@ class ResNet50(BaseNet):
         'block2',
     ]
     SummaryScalarAttrs = []
+    BatchNormEpsilon = 1e-5
+
+    class Precision:
+        Float32 = 'float32'
+        Float16 = 'float16'
+        Int8 = 'int8'
+
+    @staticmethod
+    def _quantize(weights):
+        # symmetric, per output channel
+        scale = np.max(np.abs(weights.reshape((-1, weights.shape[-1]))), axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        quantized = np.round(weights / scale).astype(np.int8)
+        return (quantized, scale.astype(np.float32))
+
+    @staticmethod
+    def _quantized_getter(getter, name, *args, **kwargs):
+        if not name.endswith('/weights'):
+            return getter(name, *args, **kwargs)
+
+        shape = kwargs.pop('shape')
+        dtype = kwargs.pop('dtype', tf.float32)
+        kwargs.update(
+            initializer=tf.zeros_initializer(),
+            regularizer=None,
+            trainable=False,
+        )
+        quantized = getter(name + '_quantized', shape=shape, dtype=tf.int8, **kwargs)
+        scale = getter(name + '_scale', shape=shape[-1:], dtype=dtype, **kwargs)
+        return tf.multiply(tf.cast(quantized, dtype), scale, name='dequantized')
 
     def __init__(self,
                  working_dir=None,
@@ -92,6 +181,8 @@ class ResNet50(BaseNet):
                  scopes_to_restore=None,
                  scopes_to_freeze=None,
                  summary_scalar_attrs=None,
+                 fold_batch_norm=False,
+                 precision=Precision.Float32,
                  learning_rate=1.0,
                  learning_rate_decay_steps=None,
                  learning_rate_decay_rate=0.5,
@@ -108,7 +199,10 @@ class ResNet50(BaseNet):
 
         self.arg_scope = self.__net.resnet_arg_scope(
             weight_decay=weight_decay,
+            batch_norm_epsilon=ResNet50.BatchNormEpsilon,
         )
+        self.fold_batch_norm = fold_batch_norm
+        self.precision = precision
 
         super(ResNet50, self).__init__(
             working_dir,
@@ -125,19 +219,89 @@ class ResNet50(BaseNet):
         )
 
     def forward(self, blob):
+        images = blob['images']
+
+        # uint8 pipelines defer conversion and mean subtraction to here, on the whole batch
+        if images.dtype == tf.uint8:
+            images = BaseProcessor._mean_subtraction(tf.to_float(images))
+
+        # folding and quantization only make sense for a graph that is never trained
+        fold_batch_norm = self.IsInference and self.fold_batch_norm
+        precision = self.precision if self.IsInference else ResNet50.Precision.Float32
+
+        if precision == ResNet50.Precision.Float16:
+            images = tf.cast(images, tf.float16)
+
         with slim.arg_scope(self.arg_scope):
-            (feat_maps, _) = self.__net.resnet_v1_50(
-                blob['images'],
-                is_training=self.IsTraining,
-                global_pool=False,
-                scope=self.__var_scope,
-            )
+            # folded convolutions carry the batch norm shift as their bias, see `read_checkpoint`
+            conv_args = dict(normalizer_fn=None, biases_initializer=tf.zeros_initializer()) if fold_batch_norm else {}
+            custom_getter = ResNet50._quantized_getter if precision == ResNet50.Precision.Int8 else None
+
+            with slim.arg_scope([slim.conv2d], **conv_args), \
+                    tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+                (feat_maps, _) = self.__net.resnet_v1_50(
+                    images,
+                    is_training=self.IsTraining,
+                    global_pool=False,
+                    scope=self.__var_scope,
+                )
+
+        if feat_maps.dtype != tf.float32:
+            feat_maps = tf.cast(feat_maps, tf.float32)
 
         return Blob(
             feat_maps=feat_maps,
             labels=blob['labels'],
         )
 
+    def read_checkpoint(self, ckpt_path, var_list):
+        if not (self.fold_batch_norm or (self.precision != ResNet50.Precision.Float32)):
+            return super(ResNet50, self).read_checkpoint(ckpt_path, var_list)
+
+        reader = tf.train.NewCheckpointReader(ckpt_path)
+
+        def get_value(name):
+            (scope, var_name) = name.rsplit('/', 1)
+            batch_norm_scope = scope + '/BatchNorm'
+            is_folded = (
+                self.fold_batch_norm and
+                (var_name in ['weights', 'biases']) and
+                (not reader.has_tensor(scope + '/biases')) and
+                reader.has_tensor(batch_norm_scope + '/moving_mean')
+            )
+            if not is_folded:
+                return reader.get_tensor(name)
+
+            mean = reader.get_tensor(batch_norm_scope + '/moving_mean')
+            variance = reader.get_tensor(batch_norm_scope + '/moving_variance')
+            gamma = (
+                reader.get_tensor(batch_norm_scope + '/gamma')
+                if reader.has_tensor(batch_norm_scope + '/gamma') else np.ones_like(mean)
+            )
+            beta = (
+                reader.get_tensor(batch_norm_scope + '/beta')
+                if reader.has_tensor(batch_norm_scope + '/beta') else np.zeros_like(mean)
+            )
+            scale = gamma / np.sqrt(variance + ResNet50.BatchNormEpsilon)
+
+            if var_name == 'weights':
+                return reader.get_tensor(name) * scale
+            else:
+                return beta - mean * scale
+
+        values = []
+        for var in var_list:
+            name = var.op.name
+            if name.endswith('/weights_quantized'):
+                (value, _) = ResNet50._quantize(get_value(name[:-len('_quantized')]))
+            elif name.endswith('/weights_scale'):
+                (_, value) = ResNet50._quantize(get_value(name[:-len('_scale')]))
+            else:
+                value = get_value(name)
+            values.append(value)
+
+        return values
+
 
 class BaseScheme(BaseNet):
     WorkingScope = None
@@ -272,25 +436,116 @@ class TestScheme(BaseScheme):
 class OnlineScheme(BaseScheme):
     WorkingScope = 'online'
     IsTraining = False
+    IsInference = True
 
     def prepare(self):
-        vars_to_restore = BaseNet.get_scope_set()
+        self.vars_to_restore = list(BaseNet.get_scope_set())
+        self.restore_placeholders = [
+            tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+            for var in self.vars_to_restore
+        ]
+        self.init_op = tf.group(*[
+            var.assign(placeholder)
+            for (var, placeholder) in zip(self.vars_to_restore, self.restore_placeholders)
+        ])
 
-        (assign_op, assign_feed_dict) = slim.assign_from_checkpoint(
-            tf.train.latest_checkpoint(TrainScheme.get_working_dir(self.working_dir)),
-            list(vars_to_restore),
-        )
+        self.restored_ckpt_path = tf.train.latest_checkpoint(TrainScheme.get_working_dir(self.working_dir))
+        self.init_feed_dict = self.get_feed_dict(self.restored_ckpt_path)
 
-        self.init_op = assign_op
-        self.init_feed_dict = assign_feed_dict
+        self.reload_lock = threading.Lock()
 
-    def run(self, graph=None):
-        self.sess = tf.Session(
+    def get_feed_dict(self, ckpt_path):
+        values = self.read_checkpoint(ckpt_path, self.vars_to_restore)
+        return {
+            placeholder: value.astype(var.dtype.base_dtype.as_numpy_dtype)
+            for (var, placeholder, value) in zip(self.vars_to_restore, self.restore_placeholders, values)
+        }
+
+    def _new_session(self, graph, feed_dict):
+        sess = tf.Session(
             graph=graph,
             config=self.session_config,
         )
-        self.sess.run(self.init_op, feed_dict=self.init_feed_dict)
-        tf.train.start_queue_runners(sess=self.sess)
+        sess.run(self.init_op, feed_dict=feed_dict)
+        tf.train.start_queue_runners(sess=sess)
+        return TrackedSession(sess)
+
+    def run(self, graph=None):
+        self.sess = self._new_session(graph, self.init_feed_dict)
+        self.init_feed_dict = None  # reloads read their own, don't pin a copy of the weights
+
+    def reload(self, ckpt_path=None):
+        with self.reload_lock:
+            ckpt_path = ckpt_path or tf.train.latest_checkpoint(TrainScheme.get_working_dir(self.working_dir))
+            if (ckpt_path is None) or (ckpt_path == self.restored_ckpt_path):
+                return False
+
+            # the new variables are loaded into a second session on the same graph, then swapped in whole
+            sess = self._new_session(self.sess.graph, self.get_feed_dict(ckpt_path))
+            (retired_sess, self.sess) = (self.sess, sess)
+            self.restored_ckpt_path = ckpt_path
+
+            # the retired session is closed as soon as the batches still running on it finish
+            thread = threading.Thread(target=retired_sess.close)
+            thread.daemon = True
+            thread.start()
+
+            tf.logging.info('Reloaded {:s}'.format(ckpt_path))
+            return True
+
+    def watch(self, interval=60, callback=None):
+        def _watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    is_reloaded = self.reload()
+                except Exception as e:  # e.g. a checkpoint still being written, retried at the next poll
+                    tf.logging.warn('Reload failed: {}'.format(e))
+                    continue
+
+                if is_reloaded and (callback is not None):
+                    callback(self.restored_ckpt_path)
+
+        thread = threading.Thread(target=_watch)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def export(self, export_dir, inputs, outputs, class_names=None):
+        input_names = [tensor.op.name for tensor in inputs.values()]
+        output_names = [tensor.op.name for tensor in outputs.values()]
+
+        # variables become constants, and everything not feeding the outputs is pruned
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self.sess,
+            self.sess.graph.as_graph_def(add_shapes=True),
+            output_names,
+        )
+
+        try:
+            from tensorflow.tools.graph_transforms import TransformGraph
+        except ImportError:
+            pass
+        else:
+            graph_def = TransformGraph(
+                graph_def,
+                input_names,
+                output_names,
+                [
+                    'fold_constants(ignore_errors=true)',
+                    'fold_batch_norms',
+                    'fold_old_batch_norms',
+                ],
+            )
+
+        FrozenNet.save(
+            export_dir,
+            graph_def=graph_def,
+            inputs=inputs,
+            outputs=outputs,
+            class_names=class_names,
+            ckpt_path=self.restored_ckpt_path,
+        )
 
 
 class ClassifyNet(ResNet50):
@@ -314,6 +569,8 @@ class ClassifyNet(ResNet50):
                  flavor=Flavor.SoftMax,
                  use_bottleneck=False,
                  output_attrs=None,
+                 fold_batch_norm=False,
+                 precision=ResNet50.Precision.Float32,
                  learning_rate=1.0,
                  learning_rate_decay_steps=None,
                  learning_rate_decay_rate=0.5,
@@ -332,6 +589,8 @@ class ClassifyNet(ResNet50):
             scopes_to_restore=scopes_to_restore,
             scopes_to_freeze=scopes_to_freeze,
             summary_scalar_attrs=summary_scalar_attrs or ClassifyNet.SummaryScalarAttrs,
+            fold_batch_norm=fold_batch_norm,
+            precision=precision,
             learning_rate=learning_rate,
             learning_rate_decay_steps=learning_rate_decay_steps,
             learning_rate_decay_rate=learning_rate_decay_rate,
@@ -346,8 +605,11 @@ class ClassifyNet(ResNet50):
         self.output_attrs = output_attrs or ClassifyNet.OutputAttrs
 
     def forward(self, blob):
-        blob = super(ClassifyNet, self).forward(blob)
-        self.feat_maps = blob['feat_maps']
+        if 'feats_2048' in blob:
+            # head only, fed from a feature store; the backbone never enters the graph
+            self.feat_maps = tf.expand_dims(tf.expand_dims(blob['feats_2048'], 1), 1)
+        else:
+            self.feat_maps = super(ClassifyNet, self).forward(blob)['feat_maps']
         self.labels = blob['labels']
 
         with slim.arg_scope(self.arg_scope), tf.variable_scope(self.__var_scope):
@@ -409,22 +671,25 @@ class ClassifyNet(ResNet50):
                     name='predictions',
                 )
 
-            self.targets = tf.one_hot(
-                self.labels,
-                depth=self.num_classes,
-            )
-            self.loss = tf.losses.log_loss(
-                labels=self.targets,
-                predictions=self.predictions,
-                weights=self.num_classes,
-                scope='loss',
-            )
-            self.total_loss = tf.losses.get_total_loss()
             self.predicted_labels = tf.argmax(self.predictions, 1)
-            self.accuracy = slim.metrics.accuracy(
-                labels=self.labels,
-                predictions=self.predicted_labels,
-            )
+
+            # serving graphs never evaluate the objective, keep it out of them
+            if not self.IsInference:
+                self.targets = tf.one_hot(
+                    self.labels,
+                    depth=self.num_classes,
+                )
+                self.loss = tf.losses.log_loss(
+                    labels=self.targets,
+                    predictions=self.predictions,
+                    weights=self.num_classes,
+                    scope='loss',
+                )
+                self.total_loss = tf.losses.get_total_loss()
+                self.accuracy = slim.metrics.accuracy(
+                    labels=self.labels,
+                    predictions=self.predicted_labels,
+                )
 
         return Blob(**{
             attr: self.__getattribute__(attr)
@@ -28,6 +28,21 @@ class Range(object):
         )) for num_crop in xrange(self.num_duplicates)]
         return val_list
 
+    def __len__(self):
+        return self.num_duplicates
+
+    def bounds(self):
+        return (self.minval, self.maxval)
+
+    def get_batch(self, size):
+        val_list = [self.post_fn(tf.random_uniform(
+            (size,),
+            minval=self.pre_fn(self.minval),
+            maxval=self.pre_fn(self.maxval),
+            dtype=self.dtype,
+        )) for num_crop in xrange(self.num_duplicates)]
+        return val_list
+
 
 class List(object):
     def __init__(self, val_list, dtype=tf.float32):
@@ -41,11 +56,29 @@ class List(object):
         ]
         return val_list
 
+    def __len__(self):
+        return len(self.val_list)
+
+    def bounds(self):
+        val_list = [val for val in self.val_list if val is not None]
+        if val_list:
+            return (min(val_list), max(val_list))
+        else:
+            return (None, None)
+
+    def get_batch(self, size):
+        val_list = [
+            tf.fill((size,), tf.constant(val, dtype=self.dtype)) if val is not None else None
+            for val in self.val_list
+        ]
+        return val_list
+
 
 class BaseProcessor(object):
     __metaclass__ = abc.ABCMeta
 
     _MEAN = [123.68, 116.78, 103.94]
+    _MEAN_UINT8 = [124, 117, 104]
 
     @staticmethod
     def _height_and_width(image):
@@ -58,9 +91,38 @@ class BaseProcessor(object):
         return image
 
     @staticmethod
-    def _decode_jpeg(content):
-        image = tf.image.decode_jpeg(content, channels=3)
+    def _decode_dim(shorter_dim, aspect_ratio):
+        (min_aspect_ratio, max_aspect_ratio) = aspect_ratio.bounds()
+        stretch = max(
+            1.0,
+            1.0 / (min_aspect_ratio or 1.0),
+            max_aspect_ratio or 1.0,
+        )
+        return int(math.ceil(shorter_dim.bounds()[1] * stretch))
+
+    @staticmethod
+    def _decode_jpeg_uint8(content, min_dim=None):
+        if (min_dim is None) or not hasattr(tf.image, 'extract_jpeg_shape'):
+            image = tf.image.decode_jpeg(content, channels=3)
+        else:
+            # DCT-domain downscaling, as long as the shorter side stays above what resize needs
+            shorter_side = tf.reduce_min(tf.image.extract_jpeg_shape(content)[:2])
+
+            def decode_fn(ratio):
+                return lambda: tf.image.decode_jpeg(content, channels=3, ratio=ratio)
+
+            image = tf.case(
+                [(tf.greater_equal(shorter_side, min_dim * ratio), decode_fn(ratio)) for ratio in [8, 4, 2]],
+                default=decode_fn(1),
+                exclusive=False,
+            )
+
         image.set_shape((None, None, 3))
+        return image
+
+    @staticmethod
+    def _decode_jpeg(content, min_dim=None):
+        image = BaseProcessor._decode_jpeg_uint8(content, min_dim=min_dim)
         image = tf.to_float(image)
         return image
 
@@ -69,6 +131,11 @@ class BaseProcessor(object):
         image = image - tf.constant(BaseProcessor._MEAN, dtype=tf.float32)
         return image
 
+    @staticmethod
+    def _to_uint8(image):
+        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+        return image
+
     @staticmethod
     def _resize(image, shorter_dim, aspect_ratio=None):
         if aspect_ratio is None:
@@ -80,11 +147,14 @@ class BaseProcessor(object):
             lambda: (shorter_dim / aspect_ratio, shorter_dim),
             lambda: (shorter_dim, shorter_dim * aspect_ratio),
         )
+        dtype = image.dtype
         image = tf.image.resize_images(
             image,
             tf.to_int32(tf.convert_to_tensor(resize_dims)),
             method=tf.image.ResizeMethod.BILINEAR,
         )
+        if dtype == tf.uint8:
+            image = BaseProcessor._to_uint8(image)
         return image
 
     @staticmethod
@@ -131,13 +201,20 @@ class BaseProcessor(object):
             crop_height=tf.minimum(target_height, original_height),
             crop_width=tf.minimum(target_width, original_width),
         )
-        image = BaseProcessor._pad(
-            image,
-            offset_height=tf.maximum(diff_height / 2, 0),
-            offset_width=tf.maximum(diff_width / 2, 0),
-            pad_height=target_height,
-            pad_width=target_width,
-        )
+        paddings = {
+            'offset_height': tf.maximum(diff_height / 2, 0),
+            'offset_width': tf.maximum(diff_width / 2, 0),
+            'pad_height': target_height,
+            'pad_width': target_width,
+        }
+        if image.dtype == tf.uint8:
+            # uint8 images are not mean-subtracted yet, so pad with the mean color to end up at zero
+            masks = BaseProcessor._pad(tf.ones_like(image), **paddings)
+            image = BaseProcessor._pad(image, **paddings)
+            image = image + (1 - masks) * tf.constant(BaseProcessor._MEAN_UINT8, dtype=tf.uint8)
+        else:
+            image = BaseProcessor._pad(image, **paddings)
+
         image.set_shape((target_height, target_width, 3))
         return image
 
@@ -172,6 +249,113 @@ class BaseProcessor(object):
         image = tf.image.adjust_contrast(image, contrast_factor=contrast)
         return image
 
+    @staticmethod
+    def _decode_jpeg_batch(contents, min_dim=None, parallel_iterations=64):
+        num_images = tf.shape(contents)[0]
+
+        def decode(index, images, heights, widths):
+            image = BaseProcessor._decode_jpeg_uint8(contents[index], min_dim=min_dim)
+            shape = tf.shape(image)
+            return (
+                index + 1,
+                images.write(index, image),
+                heights.write(index, shape[0]),
+                widths.write(index, shape[1]),
+            )
+
+        (_, images, heights, widths) = tf.while_loop(
+            lambda index, *args: index < num_images,
+            decode,
+            (
+                tf.constant(0),
+                tf.TensorArray(tf.uint8, size=num_images, infer_shape=False),
+                tf.TensorArray(tf.int32, size=num_images),
+                tf.TensorArray(tf.int32, size=num_images),
+            ),
+            parallel_iterations=parallel_iterations,
+        )
+        heights = heights.stack()
+        widths = widths.stack()
+        max_height = tf.maximum(tf.reduce_max(heights), 1)
+        max_width = tf.maximum(tf.reduce_max(widths), 1)
+
+        def pad(index, canvas):
+            image = images.read(index)
+            paddings = (
+                (0, max_height - heights[index]),
+                (0, max_width - widths[index]),
+                (0, 0),
+            )
+
+            # the canvas stays uint8, so pad with the mean color to end up at zero after mean subtraction
+            masks = tf.pad(tf.ones_like(image), paddings)
+            image = tf.pad(image, paddings) + (1 - masks) * tf.constant(BaseProcessor._MEAN_UINT8, dtype=tf.uint8)
+            return (index + 1, canvas.write(index, image))
+
+        (_, canvas) = tf.while_loop(
+            lambda index, *args: index < num_images,
+            pad,
+            (
+                tf.constant(0),
+                tf.TensorArray(tf.uint8, size=num_images),
+            ),
+            parallel_iterations=parallel_iterations,
+        )
+        canvas = canvas.stack()
+        canvas.set_shape((None, None, None, 3))
+        return (canvas, heights, widths)
+
+    @staticmethod
+    def _extrapolation_masks_batch(canvas, boxes, crop_dim):
+        # zero where crop_and_resize samples outside the canvas, mirroring its own bounds check
+        norm_height = tf.to_float(tf.shape(canvas)[1] - 1)
+        norm_width = tf.to_float(tf.shape(canvas)[2] - 1)
+        steps = tf.to_float(tf.range(crop_dim)) / max(crop_dim - 1, 1)
+
+        (y1, x1, y2, x2) = tf.unstack(boxes, axis=1)
+        ys = tf.expand_dims(y1 * norm_height, 1) + tf.expand_dims((y2 - y1) * norm_height, 1) * steps
+        xs = tf.expand_dims(x1 * norm_width, 1) + tf.expand_dims((x2 - x1) * norm_width, 1) * steps
+        masks = tf.logical_and(
+            tf.expand_dims(tf.logical_and(ys >= 0, ys <= norm_height), 2),
+            tf.expand_dims(tf.logical_and(xs >= 0, xs <= norm_width), 1),
+        )
+        return tf.expand_dims(tf.to_float(masks), 3)
+
+    @staticmethod
+    def _resize_dims_batch(heights, widths, shorter_dim, aspect_ratio=None):
+        if aspect_ratio is None:
+            aspect_ratio = tf.to_float(widths) / tf.to_float(heights)
+
+        resize_heights = tf.floor(tf.where(tf.less(aspect_ratio, 1.0), shorter_dim / aspect_ratio, shorter_dim))
+        resize_widths = tf.floor(tf.where(tf.less(aspect_ratio, 1.0), shorter_dim, shorter_dim * aspect_ratio))
+        return (resize_heights, resize_widths)
+
+    @staticmethod
+    def _crop_box_batch(canvas, heights, widths, resize_heights, resize_widths, offset_heights, offset_widths, crop_dim, flips=None):
+        # a crop of the resized image, expressed as a box on the padded canvas of original images
+        scale_heights = tf.to_float(heights) / resize_heights
+        scale_widths = tf.to_float(widths) / resize_widths
+        norm_height = tf.to_float(tf.maximum(tf.shape(canvas)[1] - 1, 1))
+        norm_width = tf.to_float(tf.maximum(tf.shape(canvas)[2] - 1, 1))
+
+        y1 = offset_heights * scale_heights / norm_height
+        x1 = offset_widths * scale_widths / norm_width
+        y2 = (offset_heights + crop_dim - 1) * scale_heights / norm_height
+        x2 = (offset_widths + crop_dim - 1) * scale_widths / norm_width
+
+        # crop_and_resize flips boxes with x1 > x2
+        if flips is not None:
+            (x1, x2) = (tf.where(flips, x2, x1), tf.where(flips, x1, x2))
+
+        return tf.stack([y1, x1, y2, x2], axis=1)
+
+    @staticmethod
+    def _adjust_batch(images, deltas, contrasts):
+        images = images + tf.reshape(deltas, (-1, 1, 1, 1))
+        means = tf.reduce_mean(images, (1, 2), keep_dims=True)
+        images = (images - means) * tf.reshape(contrasts, (-1, 1, 1, 1)) + means
+        return images
+
     @staticmethod
     def _apply(func, arg_list_dict):
         return [
@@ -181,14 +365,27 @@ class BaseProcessor(object):
 
     def __init__(self,
                  net_dim,
-                 batch_size=64):
+                 batch_size=64,
+                 batched=False,
+                 decode_dim=None,
+                 dtype=tf.float32):
 
         self.net_dim = net_dim
         self.shape = (net_dim, net_dim, 3)
         self.batch_size = batch_size
+        self.batched = batched
+        self.decode_dim = decode_dim
+        self.dtype = dtype
 
     def decode_jpeg(self, content):
-        return BaseProcessor._decode_jpeg(content)
+        image = BaseProcessor._decode_jpeg_uint8(content, min_dim=self.decode_dim)
+        return self.convert_image(image)
+
+    def convert_image(self, image):
+        if self.dtype == tf.uint8:
+            return image
+        else:
+            return tf.to_float(image)
 
     def duplicate(self, image, num_duplicates=1):
         return [image] * num_duplicates
@@ -200,6 +397,10 @@ class BaseProcessor(object):
         })
 
     def mean_subtraction(self, images):
+        # uint8 images are mean-subtracted by the net, on the whole batch
+        if self.dtype == tf.uint8:
+            return images
+
         return BaseProcessor._apply(BaseProcessor._mean_subtraction, {
             'image': images,
         })
@@ -241,6 +442,10 @@ class BaseProcessor(object):
         })
 
     def adjust(self, images, delta, contrast):
+        # uint8 images would be clipped, they are only repeated here and adjusted in float by adjust_batch
+        if self.dtype == tf.uint8:
+            return [image for image in images for _ in xrange(len(delta) * len(contrast))]
+
         return BaseProcessor._apply(BaseProcessor._adjust, {
             'image': images,
             'delta': delta.get(),
@@ -253,19 +458,69 @@ class BaseProcessor(object):
 
     def preprocess_single(self, content):
         image = self.decode_jpeg(content)
+        return self.preprocess_decoded(image)
+
+    def preprocess_decoded(self, image):
         images = self.preprocess_image(image)
         images = tf.stack(images)
         return images
 
-    def preprocess(self, blob):
-        with tf.variable_scope(_('preprocess')):
-            images = tf.map_fn(
-                self.preprocess_single,
-                blob['contents'],
-                dtype=tf.float32,
-                parallel_iterations=self.batch_size,
+    def preprocess_batch_params(self, canvas, heights, widths):  # implemented by processors supporting batched mode
+        pass
+
+    def preprocess_batch(self, contents):
+        (canvas, heights, widths) = BaseProcessor._decode_jpeg_batch(
+            contents,
+            min_dim=self.decode_dim,
+            parallel_iterations=self.batch_size,
+        )
+
+        # one crop per image and repeat, all resized in a single op
+        params = self.preprocess_batch_params(canvas, heights, widths)
+        num_images = tf.shape(canvas)[0]
+        num_repeats = len(params)
+
+        boxes = tf.reshape(tf.stack([param['box'] for param in params], axis=1), (-1, 4))
+        box_indices = tf.reshape(tf.tile(tf.expand_dims(tf.range(num_images), 1), (1, num_repeats)), (-1,))
+        images = tf.image.crop_and_resize(canvas, boxes, box_indices, (self.net_dim, self.net_dim))
+
+        # only the crops are mean-subtracted, samples outside the canvas read as the mean color
+        images = BaseProcessor._mean_subtraction(images)
+        images = images * BaseProcessor._extrapolation_masks_batch(canvas, boxes, self.net_dim)
+
+        if 'delta' in params[0]:
+            images = BaseProcessor._adjust_batch(
+                images,
+                deltas=tf.reshape(tf.stack([param['delta'] for param in params], axis=1), (-1,)),
+                contrasts=tf.reshape(tf.stack([param['contrast'] for param in params], axis=1), (-1,)),
             )
 
+        images = tf.reshape(images, (-1, num_repeats) + self.shape)
+
+        # adjusted crops stay float, converting them back to uint8 would clip them
+        if (self.dtype == tf.uint8) and ('delta' not in params[0]):
+            images = BaseProcessor._to_uint8(images + tf.constant(BaseProcessor._MEAN, dtype=tf.float32))
+        return images
+
+    def adjust_batch(self, images):  # implemented by processors deferring adjustment of uint8 images
+        return images
+
+    def preprocess(self, blob):
+        with tf.variable_scope(_('preprocess')):
+            # producers may have already run preprocess_single on their own threads
+            if 'images' in blob:
+                images = blob['images']
+            elif self.batched:
+                images = self.preprocess_batch(blob['contents'])
+            else:
+                images = tf.map_fn(
+                    self.preprocess_single,
+                    blob['contents'],
+                    dtype=self.dtype,
+                    parallel_iterations=self.batch_size,
+                )
+
+            images = self.adjust_batch(images)
             shape = images.get_shape().as_list()
             new_shape = [-1] + shape[2:]
             self.images = tf.reshape(images, new_shape)
@@ -297,11 +552,17 @@ class TrainProcessor(BaseProcessor):
                  delta=Range((-64, 64)),
                  contrast=Range((0.5, 1.5)),
                  batch_size=64,
-                 num_duplicates=1):
+                 num_duplicates=1,
+                 batched=False,
+                 scaled_decode=False,
+                 dtype=tf.float32):
 
         super(TrainProcessor, self).__init__(
             net_dim=net_dim,
             batch_size=batch_size,
+            batched=batched,
+            decode_dim=BaseProcessor._decode_dim(shorter_dim, aspect_ratio) if scaled_decode else None,
+            dtype=dtype,
         )
 
         self.num_duplicates = num_duplicates
@@ -319,17 +580,72 @@ class TrainProcessor(BaseProcessor):
         images = self.adjust(images, delta=self.delta, contrast=self.contrast)
         return images
 
+    def adjust_batch(self, images):
+        if images.dtype != tf.uint8:
+            return images
+
+        # the same adjustment as the float path, on mean-subtracted values and without clipping
+        shape = images.get_shape().as_list()
+        images = tf.reshape(images, [-1, len(self.delta) * len(self.contrast)] + shape[2:])
+        num_images = tf.shape(images)[0]
+        (deltas, contrasts) = zip(*itertools.product(
+            self.delta.get_batch(num_images),
+            self.contrast.get_batch(num_images),
+        ))
+
+        images = BaseProcessor._mean_subtraction(tf.to_float(tf.reshape(images, [-1] + shape[2:])))
+        images = BaseProcessor._adjust_batch(
+            images,
+            deltas=tf.reshape(tf.stack(deltas, axis=1), (-1,)),
+            contrasts=tf.reshape(tf.stack(contrasts, axis=1), (-1,)),
+        )
+        images = tf.reshape(images, [-1] + shape[1:])
+        return images
+
+    def preprocess_batch_params(self, canvas, heights, widths):
+        num_images = tf.shape(canvas)[0]
+
+        params = []
+        for (num_duplicate, shorter_dim, aspect_ratio, delta, contrast) in itertools.product(
+                xrange(self.num_duplicates),
+                self.shorter_dim.get_batch(num_images),
+                self.aspect_ratio.get_batch(num_images),
+                self.delta.get_batch(num_images),
+                self.contrast.get_batch(num_images)):
+
+            (resize_heights, resize_widths) = BaseProcessor._resize_dims_batch(heights, widths, shorter_dim, aspect_ratio)
+            offset_heights = tf.floor(tf.random_uniform((num_images,)) * tf.maximum(resize_heights - self.net_dim + 1, 1))
+            offset_widths = tf.floor(tf.random_uniform((num_images,)) * tf.maximum(resize_widths - self.net_dim + 1, 1))
+            flips = tf.less(tf.random_uniform((num_images,)), 0.5)
+
+            params.append({
+                'box': BaseProcessor._crop_box_batch(
+                    canvas, heights, widths, resize_heights, resize_widths,
+                    offset_heights, offset_widths, self.net_dim, flips=flips,
+                ),
+                'delta': delta,
+                'contrast': contrast,
+            })
+
+        return params
+
 
 class TestProcessor(BaseProcessor):
     def __init__(self,
                  net_dim=256,
                  shorter_dim=List([256, 512]),
                  aspect_ratio=List([1.0]),
-                 batch_size=16):
+                 batch_size=16,
+                 batched=False,
+                 scaled_decode=False,
+                 dtype=tf.float32):
 
         super(TestProcessor, self).__init__(
             net_dim=net_dim,
             batch_size=batch_size,
+            batched=batched,
+            decode_dim=BaseProcessor._decode_dim(shorter_dim, aspect_ratio) if scaled_decode else None,
+            dtype=dtype,
         )
 
         self.shorter_dim = shorter_dim
@@ -341,3 +657,33 @@ class TestProcessor(BaseProcessor):
         images = self.resize(images, shorter_dim=self.shorter_dim, aspect_ratio=self.aspect_ratio)
         images = self.central_crop_or_pad(images)
         return images
+
+    def preprocess_batch_params(self, canvas, heights, widths):
+        num_images = tf.shape(canvas)[0]
+
+        params = []
+        for (shorter_dim, aspect_ratio) in itertools.product(
+                self.shorter_dim.get_batch(num_images),
+                self.aspect_ratio.get_batch(num_images)):
+
+            (resize_heights, resize_widths) = BaseProcessor._resize_dims_batch(heights, widths, shorter_dim, aspect_ratio)
+
+            # negative offsets reach outside the image and are filled with zeros, like _central_crop_or_pad
+            params.append({
+                'box': BaseProcessor._crop_box_batch(
+                    canvas, heights, widths, resize_heights, resize_widths,
+                    tf.floor((resize_heights - self.net_dim) / 2), tf.floor((resize_widths - self.net_dim) / 2), self.net_dim,
+                ),
+            })
+
+        return params
+
+    def cache_key(self):
+        return repr((
+            type(self).__name__,
+            self.net_dim,
+            self.shorter_dim.val_list,
+            self.aspect_ratio.val_list,
+            self.decode_dim,
+            self.dtype.name,
+        ))
@@ -1,10 +1,15 @@
 from __future__ import print_function
 
+import hashlib
+import multiprocessing
 import numpy as np
 import os
 import tensorflow as tf
+import threading
 
 from .blob import Blob
+from .manifest import Manifest
+from .processor import BaseProcessor, TrainProcessor, TestProcessor
 from .util import scope_join_fn
 
 _ = scope_join_fn('producer')
@@ -14,16 +19,26 @@ class BaseProducer(object):
     BufferCapacity = 256
 
     @staticmethod
-    def queue_join(values_list, dtypes=None, shapes=None, enqueue_many=False, name='queue_join'):
+    def queue_join(values_list, dtypes=None, shapes=None, enqueue_many=False, min_after_dequeue=None, name='queue_join'):
         dtypes = dtypes or [value.dtype for value in values_list[0]]
         shapes = shapes or [value.get_shape()[enqueue_many:] for value in values_list[0]]
 
-        queue = tf.FIFOQueue(
-            capacity=BaseProducer.BufferCapacity,
-            dtypes=dtypes,
-            shapes=shapes,
-            name=name,
-        )
+        # a shuffle buffer for sources read in a fixed order
+        if min_after_dequeue is None:
+            queue = tf.FIFOQueue(
+                capacity=BaseProducer.BufferCapacity,
+                dtypes=dtypes,
+                shapes=shapes,
+                name=name,
+            )
+        else:
+            queue = tf.RandomShuffleQueue(
+                capacity=min_after_dequeue + BaseProducer.BufferCapacity,
+                min_after_dequeue=min_after_dequeue,
+                dtypes=dtypes,
+                shapes=shapes,
+                name=name,
+            )
 
         if enqueue_many:
             enqueue_fn = queue.enqueue_many
@@ -37,6 +52,130 @@ class BaseProducer(object):
         return queue
 
 
+class FileIndex(object):
+    ChunkSize = 4096
+
+    def __init__(self, file_names, labels, seed=None):
+        # kept in python, a graph embedding every path grows with the dataset toward the protobuf limit
+        self.file_names = np.array(file_names, dtype=np.object)
+        self.labels = np.array(labels, dtype=np.int64)
+
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.permutation = np.zeros((0,), dtype=np.int64)
+        self.offset = 0
+        self.num_epochs = 0
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def next_indices(self, size):
+        with self.lock:
+            # a fresh permutation every epoch, so shuffling is global but nothing is materialized twice
+            if self.offset >= len(self.permutation):
+                self.permutation = self.random.permutation(len(self))
+                self.offset = 0
+                self.num_epochs += 1
+
+            indices = self.permutation[self.offset:self.offset + size]
+            self.offset += len(indices)
+
+        return indices
+
+    def next_chunk(self, size=ChunkSize):
+        indices = self.next_indices(size)
+        return (self.file_names[indices], self.labels[indices])
+
+    def generate(self):
+        while True:
+            (file_names, labels) = self.next_chunk()
+            for (file_name, label) in zip(file_names, labels):
+                yield (file_name, label)
+
+    def chunk(self, size=ChunkSize):
+        (file_names, labels) = tf.py_func(
+            lambda: self.next_chunk(size),
+            [],
+            [tf.string, tf.int64],
+            stateful=True,
+            name='file_index_chunk',
+        )
+        file_names.set_shape((None,))
+        labels.set_shape((None,))
+        return (file_names, labels)
+
+
+class WeightedFileIndex(FileIndex):
+    @staticmethod
+    def _alias_table(weights):
+        # Vose's alias method, O(1) per draw from an arbitrary discrete distribution
+        num_classes = len(weights)
+        probs = num_classes * np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        aliases = np.arange(num_classes, dtype=np.int64)
+
+        smalls = [index for index in xrange(num_classes) if probs[index] < 1.0]
+        larges = [index for index in xrange(num_classes) if probs[index] >= 1.0]
+        while smalls and larges:
+            small = smalls.pop()
+            large = larges.pop()
+
+            aliases[small] = large
+            probs[large] -= 1.0 - probs[small]
+            if probs[large] < 1.0:
+                smalls.append(large)
+            else:
+                larges.append(large)
+
+        for index in smalls + larges:
+            probs[index] = 1.0
+
+        return (probs, aliases)
+
+    def __init__(self, file_names, labels, num_classes, weights, seed=None):
+        super(WeightedFileIndex, self).__init__(file_names, labels, seed=seed)
+
+        # files grouped by class, so a class and an offset within it address a file
+        order = np.argsort(self.labels, kind='mergesort')
+        self.file_names = self.file_names[order]
+        self.labels = self.labels[order]
+
+        self.num_files = np.bincount(self.labels, minlength=num_classes)
+        self.offsets = np.cumsum(self.num_files) - self.num_files
+        self.num_samples = 0
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        # a callable is re-evaluated on the number of samples drawn, to change the mix over training
+        if callable(weights):
+            self.weight_fn = weights
+            weights = weights(self.num_samples)
+        else:
+            self.weight_fn = None
+
+        weights = np.asarray(weights, dtype=np.float64) * (self.num_files > 0)
+        (probs, aliases) = WeightedFileIndex._alias_table(weights)
+
+        with self.lock:
+            (self.weights, self.probs, self.aliases) = (weights, probs, aliases)
+
+    def next_indices(self, size):
+        if self.weight_fn is not None:
+            weights = np.asarray(self.weight_fn(self.num_samples), dtype=np.float64) * (self.num_files > 0)
+            if not np.array_equal(weights, self.weights):
+                self.set_weights(self.weight_fn)
+
+        with self.lock:
+            columns = self.random.randint(len(self.probs), size=size)
+            is_kept = self.random.random_sample(size) < self.probs[columns]
+            labels = np.where(is_kept, columns, self.aliases[columns])
+
+            offsets = (self.random.random_sample(size) * self.num_files[labels]).astype(np.int64)
+            indices = self.offsets[labels] + offsets
+            self.num_samples += size
+
+        return indices
+
+
 class ClassifyProducer(BaseProducer):
     ClassNameFileName = 'class_names.txt'
 
@@ -54,16 +193,19 @@ class ClassifyProducer(BaseProducer):
             if os.path.isfile(self.classname_path):
                 self.class_names = np.loadtxt(self.classname_path, dtype=np.str)
             else:
-                self.class_names = np.sort([
-                    class_name
-                    for class_name in os.listdir(image_dir)
-                    if not class_name.startswith('.')
-                    if os.path.isdir(os.path.join(image_dir, class_name))
-                ])
+                self.class_names = self.get_class_names()
                 np.savetxt(self.classname_path, self.class_names, fmt='%s')
 
             self.num_classes = len(self.class_names)
 
+    def get_class_names(self):
+        return np.sort([
+            class_name
+            for class_name in os.listdir(self.image_dir)
+            if not class_name.startswith('.')
+            if os.path.isdir(os.path.join(self.image_dir, class_name))
+        ])
+
 
 class ImageNetFileProducer(ClassifyProducer):
     class SubsampleFunction(object):
@@ -82,6 +224,8 @@ class ImageNetFileProducer(ClassifyProducer):
     class MixScheme:
         NoScheme = 0
         Uniform = 1
+        Sqrt = 2
+        Weighted = 3
 
     def __init__(self,
                  working_dir=None,
@@ -89,7 +233,10 @@ class ImageNetFileProducer(ClassifyProducer):
                  batch_size=64,
                  num_parallels=8,
                  subsample_fn=SubsampleFunction.NoSubsample(),
-                 mix_scheme=MixScheme.NoScheme):
+                 mix_scheme=MixScheme.NoScheme,
+                 class_weights=None,
+                 manifest_path=None,
+                 num_scanners=16):
 
         super(ImageNetFileProducer, self).__init__(
             working_dir=working_dir,
@@ -97,24 +244,19 @@ class ImageNetFileProducer(ClassifyProducer):
             batch_size=batch_size,
         )
 
-        self.filenames_by_subdir = {}
-        for subdir_name in os.listdir(image_dir):
-            if subdir_name.startswith('.'):
-                continue
-
-            self.filenames_by_subdir[subdir_name] = []
-
-            subdir_path = os.path.join(image_dir, subdir_name)
-            for (file_dir, _, file_names) in os.walk(subdir_path, followlinks=True):
-                for file_name in file_names:
-                    if file_name.startswith('.'):
-                        continue
-                    if not file_name.endswith('.jpg'):
-                        continue
-                    if not subsample_fn(file_name):
-                        continue
+        self.manifest = Manifest(
+            image_dir,
+            manifest_path=manifest_path,
+            working_dir=working_dir,
+        ).load().update(num_threads=num_scanners).save()
 
-                    self.filenames_by_subdir[subdir_name].append(os.path.join(file_dir, file_name))
+        self.filenames_by_subdir = {}
+        for subdir_name in sorted(self.manifest.entries.keys()):
+            self.filenames_by_subdir[subdir_name] = [
+                file_path
+                for file_path in self.manifest.file_paths(subdir_name)
+                if subsample_fn(os.path.basename(file_path))
+            ]
 
             print('Subdir {:s} ({:d})'.format(subdir_name, len(self.filenames_by_subdir[subdir_name])))
 
@@ -123,37 +265,52 @@ class ImageNetFileProducer(ClassifyProducer):
         self.num_parallels = num_parallels
         self.subsample_fn = subsample_fn
         self.mix_scheme = mix_scheme
+        self.class_weights = class_weights
 
-    def blob(self):
-        with tf.variable_scope(_(None)):
-            if self.mix_scheme == LocalFileProducer.MixScheme.NoScheme:
-                filename_labels = []
-                for (subdir_name, file_names) in self.filenames_by_subdir.items():
-                    if subdir_name in self.class_names:
-                        label = np.flatnonzero(self.class_names == subdir_name)[0]
-                    else:
-                        label = -1
+    def get_class_weights(self):
+        num_files = np.array([len(self.filenames_by_subdir[class_name]) for class_name in self.class_names])
 
-                    for file_name in file_names:
-                        filename_labels.append((file_name, label))
+        if self.mix_scheme == ImageNetFileProducer.MixScheme.Uniform:
+            return np.ones(self.num_classes)
+        elif self.mix_scheme == ImageNetFileProducer.MixScheme.Sqrt:
+            return np.sqrt(num_files)
+        elif self.mix_scheme == ImageNetFileProducer.MixScheme.Weighted:
+            return self.class_weights
 
-                (file_names, labels) = zip(*filename_labels)
+    def get_file_index(self):
+        if self.mix_scheme == ImageNetFileProducer.MixScheme.NoScheme:
+            return FileIndex(*zip(*self.get_filename_labels()))
+        else:
+            assert set(self.filenames_by_subdir.keys()) == set(self.class_names)
 
-                indices = tf.random_shuffle(tf.range(len(filename_labels), dtype=tf.int64))
-                labels = tf.gather(labels, indices)
-                labels = tf.cast(labels, dtype=tf.int64)
-                file_names = tf.gather(file_names, indices)
+            # one sampler for all classes, instead of a queue and a runner thread per class
+            (file_names, labels) = zip(*self.get_filename_labels())
+            return WeightedFileIndex(
+                file_names,
+                labels,
+                num_classes=self.num_classes,
+                weights=self.get_class_weights(),
+            )
 
-            elif self.mix_scheme == LocalFileProducer.MixScheme.Uniform:
-                assert set(self.filenames_by_subdir.keys()) == set(self.class_names)
+    def get_label(self, subdir_name):
+        if subdir_name in self.class_names:
+            return np.flatnonzero(self.class_names == subdir_name)[0]
+        else:
+            return -1
+
+    def get_filename_labels(self):
+        filename_labels = []
+        for (subdir_name, file_names) in self.filenames_by_subdir.items():
+            label = self.get_label(subdir_name)
+            for file_name in file_names:
+                filename_labels.append((file_name, label))
 
-                file_names = []
-                for class_name in self.class_names:
-                    file_name = tf.train.string_input_producer(self.filenames_by_subdir[class_name], name=class_name).dequeue()
-                    file_names.append(file_name)
+        return filename_labels
 
-                labels = tf.random_shuffle(tf.range(self.num_classes, dtype=tf.int64))
-                file_names = tf.gather(file_names, labels)
+    def blob(self):
+        with tf.variable_scope(_(None)):
+            self.file_index = self.get_file_index()
+            (file_names, labels) = self.file_index.chunk()
 
             filename_label_queue = BaseProducer.queue_join(
                 [(file_names, labels)],
@@ -175,6 +332,723 @@ class ImageNetFileProducer(ClassifyProducer):
         return Blob(contents=self.contents, labels=self.labels)
 
 
+class DatasetProducer(ImageNetFileProducer):
+    ShuffleBufferSize = 16384
+    NumParallels = 8
+    PrefetchSize = 2
+
+    @staticmethod
+    def _autotune():
+        # the constant moved around across releases, and is absent before 1.8
+        for get_module in [
+                lambda: tf.data,
+                lambda: tf.data.experimental,
+                lambda: tf.contrib.data]:
+            try:
+                return get_module().AUTOTUNE
+            except AttributeError:
+                continue
+        return None
+
+    def __init__(self,
+                 working_dir=None,
+                 image_dir=None,
+                 batch_size=64,
+                 num_parallels=None,
+                 subsample_fn=ImageNetFileProducer.SubsampleFunction.NoSubsample(),
+                 mix_scheme=ImageNetFileProducer.MixScheme.NoScheme,
+                 class_weights=None,
+                 manifest_path=None,
+                 num_scanners=16,
+                 processor=None,
+                 shuffle_buffer_size=ShuffleBufferSize,
+                 prefetch_size=None):
+
+        if not hasattr(tf, 'data'):
+            raise ImportError('DatasetProducer requires tf.data (tensorflow>=1.4)')
+
+        super(DatasetProducer, self).__init__(
+            working_dir=working_dir,
+            image_dir=image_dir,
+            batch_size=batch_size,
+            num_parallels=num_parallels,
+            subsample_fn=subsample_fn,
+            mix_scheme=mix_scheme,
+            class_weights=class_weights,
+            manifest_path=manifest_path,
+            num_scanners=num_scanners,
+        )
+
+        self.processor = processor
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.prefetch_size = prefetch_size
+
+    def _dataset(self):
+        self.file_index = self.get_file_index()
+        dataset = tf.data.Dataset.from_generator(
+            self.file_index.generate,
+            (tf.string, tf.int64),
+            ((), ()),
+        )
+
+        # the index is permuted per epoch outside the graph, the buffer only breaks up chunk boundaries;
+        # weighted draws are independent already
+        if self.mix_scheme == DatasetProducer.MixScheme.NoScheme:
+            dataset = dataset.shuffle(min(self.shuffle_buffer_size, len(self.file_index)))
+
+        return dataset
+
+    def blob(self):
+        with tf.variable_scope(_(None)):
+            # decode and preprocessing are fused into the parallel map when a processor is given
+            def read(file_name, label):
+                content = tf.read_file(file_name)
+                if self.processor is None:
+                    return (content, label)
+                else:
+                    return (self.processor.preprocess_single(content), label)
+
+            # unset sizes are left to the runtime where it can tune them
+            autotune = DatasetProducer._autotune()
+            num_parallel_calls = self.num_parallels or autotune or DatasetProducer.NumParallels
+            prefetch_size = self.prefetch_size or autotune or DatasetProducer.PrefetchSize
+
+            dataset = self._dataset()
+            dataset = dataset.map(read, num_parallel_calls=num_parallel_calls)
+            dataset = dataset.batch(self.batch_size)
+            dataset = dataset.prefetch(prefetch_size)
+
+            (values, self.labels) = dataset.make_one_shot_iterator().get_next()
+
+        if self.processor is None:
+            self.contents = values
+            return Blob(contents=self.contents, labels=self.labels)
+        else:
+            self.images = values
+            return Blob(images=self.images, labels=self.labels)
+
+
+class TensorCacheProducer(ImageNetFileProducer):
+    CacheFileName = 'tensor_cache-{:s}.npy'
+    ValidFileName = 'tensor_cache-{:s}.valid.npy'  # rows that decoded, the cache itself is renamed into place last
+
+    def __init__(self,
+                 processor,
+                 working_dir=None,
+                 image_dir=None,
+                 batch_size=64,
+                 num_parallels=8,
+                 subsample_fn=ImageNetFileProducer.SubsampleFunction.NoSubsample(),
+                 manifest_path=None,
+                 num_scanners=16,
+                 cache_dir=None,
+                 dtype=None):
+
+        super(TensorCacheProducer, self).__init__(
+            working_dir=working_dir,
+            image_dir=image_dir,
+            batch_size=batch_size,
+            num_parallels=num_parallels,
+            subsample_fn=subsample_fn,
+            mix_scheme=ImageNetFileProducer.MixScheme.NoScheme,
+            manifest_path=manifest_path,
+            num_scanners=num_scanners,
+        )
+
+        self.processor = processor
+        if dtype is not None:
+            self.dtype = dtype
+        elif processor.dtype == tf.uint8:
+            self.dtype = np.uint8
+        else:
+            self.dtype = np.float16
+
+        (self.file_names, self.file_labels) = zip(*sorted(self.get_filename_labels()))
+        key = hashlib.sha1(repr((
+            self.file_names,
+            self.file_labels,
+            processor.cache_key(),
+            np.dtype(self.dtype).str,
+        ))).hexdigest()
+        self.cache_path = os.path.join(cache_dir or working_dir, TensorCacheProducer.CacheFileName.format(key))
+        self.valid_path = os.path.join(cache_dir or working_dir, TensorCacheProducer.ValidFileName.format(key))
+
+    def build(self):
+        if os.path.isfile(self.cache_path) and os.path.isfile(self.valid_path):
+            return self
+
+        with tf.Graph().as_default():
+            contents = tf.placeholder(tf.string, shape=(None,))
+            images = tf.map_fn(
+                self.processor.preprocess_single,
+                contents,
+                dtype=self.processor.dtype,
+                parallel_iterations=self.batch_size,
+            )
+
+            tmp_path = '{:s}.{:d}.tmp'.format(self.cache_path, os.getpid())
+            cache = np.lib.format.open_memmap(
+                tmp_path,
+                mode='w+',
+                dtype=self.dtype,
+                shape=(len(self.file_names),) + tuple(images.get_shape().as_list()[1:]),
+            )
+            is_valid = np.zeros((len(self.file_names),), dtype=np.bool)
+
+            with tf.Session() as sess:
+                for offset in xrange(0, len(self.file_names), self.batch_size):
+                    contents_ = []
+                    for file_name in self.file_names[offset:offset + self.batch_size]:
+                        with open(file_name, 'rb') as f:
+                            contents_.append(f.read())
+
+                    # undecodable images are left as zeros and marked invalid, they are never served
+                    try:
+                        cache[offset:offset + len(contents_)] = sess.run(images, feed_dict={contents: contents_})
+                        is_valid[offset:offset + len(contents_)] = True
+                    except tf.errors.OpError:
+                        for (num_content, content) in enumerate(contents_):
+                            try:
+                                cache[offset + num_content] = sess.run(images, feed_dict={contents: [content]})[0]
+                                is_valid[offset + num_content] = True
+                            except tf.errors.OpError:
+                                print('Skipping {:s}'.format(self.file_names[offset + num_content]))
+
+                    print('Cached {:d}/{:d}'.format(offset + len(contents_), len(self.file_names)))
+
+            cache.flush()
+            del cache
+            np.save(self.valid_path, is_valid)
+            os.rename(tmp_path, self.cache_path)
+
+        return self
+
+    def blob(self):
+        self.build()
+        self.cache = np.load(self.cache_path, mmap_mode='r')
+        file_labels = np.asarray(self.file_labels, dtype=np.int64)
+        valid_indices = np.flatnonzero(np.load(self.valid_path))
+
+        # an epoch covers the decodable rows only
+        self.num_files = len(valid_indices)
+        self.num_batches_per_epoch = self.num_files // self.batch_size
+
+        def read(indices):
+            indices = valid_indices[indices]
+            return (self.cache[indices].astype(self.processor.dtype.as_numpy_dtype), file_labels[indices])
+
+        with tf.variable_scope(_(None)):
+            indices = tf.train.range_input_producer(len(valid_indices), shuffle=False).dequeue_many(self.batch_size)
+            (self.images, self.labels) = tf.py_func(read, [indices], [self.processor.dtype, tf.int64], stateful=False)
+            self.images.set_shape((None,) + self.cache.shape[1:])
+            self.labels.set_shape((None,))
+
+        return Blob(images=self.images, labels=self.labels)
+
+
+def _run_decode_worker(processor, filename_labels, batch_size, dtype, shape, images_buffer, labels_buffer, free_slots, full_slots, seed):
+    # each worker owns a private single-threaded graph, so it does not compete for the trainer's intra-op threads
+    with tf.Graph().as_default():
+        content = tf.placeholder(tf.string, shape=())
+        images = processor.preprocess_single(content)
+        sess = tf.Session(config=tf.ConfigProto(
+            intra_op_parallelism_threads=1,
+            inter_op_parallelism_threads=1,
+        ))
+
+    images_array = np.frombuffer(images_buffer, dtype=dtype).reshape((-1, batch_size) + shape)
+    labels_array = np.frombuffer(labels_buffer, dtype=np.int64).reshape((-1, batch_size))
+    random_state = np.random.RandomState(seed)
+
+    def filename_label_iter():
+        while True:
+            for index in random_state.permutation(len(filename_labels)):
+                yield filename_labels[index]
+
+    filename_labels_ = filename_label_iter()
+    while True:
+        slot = free_slots.get()
+        if slot is None:
+            return
+
+        num_images = 0
+        while num_images < batch_size:
+            (file_name, label) = next(filename_labels_)
+            try:
+                with open(file_name, 'rb') as f:
+                    images_array[slot, num_images] = sess.run(images, feed_dict={content: f.read()})
+            except (IOError, tf.errors.OpError):
+                continue
+
+            labels_array[slot, num_images] = label
+            num_images += 1
+
+        full_slots.put(slot)
+
+
+class MultiProcessProducer(ImageNetFileProducer):
+    def __init__(self,
+                 processor,
+                 working_dir=None,
+                 image_dir=None,
+                 batch_size=64,
+                 subsample_fn=ImageNetFileProducer.SubsampleFunction.NoSubsample(),
+                 manifest_path=None,
+                 num_scanners=16,
+                 num_workers=multiprocessing.cpu_count() // 2,
+                 num_slots=None):
+
+        super(MultiProcessProducer, self).__init__(
+            working_dir=working_dir,
+            image_dir=image_dir,
+            batch_size=batch_size,
+            subsample_fn=subsample_fn,
+            mix_scheme=ImageNetFileProducer.MixScheme.NoScheme,
+            manifest_path=manifest_path,
+            num_scanners=num_scanners,
+        )
+
+        self.processor = processor
+        self.num_workers = max(num_workers, 1)
+        self.num_slots = num_slots or 2 * self.num_workers
+        self.workers = []
+
+    def start(self):
+        with tf.Graph().as_default():
+            shape = self.processor.preprocess_single(tf.placeholder(tf.string, shape=())).get_shape()
+
+        self.shape = tuple(shape.as_list())
+        self.dtype = self.processor.dtype.as_numpy_dtype
+
+        # a ring of batch slots in shared memory, slot ids travel through the two queues
+        self.images_buffer = multiprocessing.RawArray(
+            'b',
+            self.num_slots * self.batch_size * int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize,
+        )
+        self.labels_buffer = multiprocessing.RawArray('b', self.num_slots * self.batch_size * np.dtype(np.int64).itemsize)
+        self.images_array = np.frombuffer(self.images_buffer, dtype=self.dtype).reshape((-1, self.batch_size) + self.shape)
+        self.labels_array = np.frombuffer(self.labels_buffer, dtype=np.int64).reshape((-1, self.batch_size))
+
+        self.free_slots = multiprocessing.Queue()
+        self.full_slots = multiprocessing.Queue()
+        for slot in xrange(self.num_slots):
+            self.free_slots.put(slot)
+
+        filename_labels = sorted(self.get_filename_labels())
+        for num_worker in xrange(self.num_workers):
+            worker = multiprocessing.Process(
+                target=_run_decode_worker,
+                args=(
+                    self.processor,
+                    filename_labels[num_worker::self.num_workers],
+                    self.batch_size,
+                    self.dtype,
+                    self.shape,
+                    self.images_buffer,
+                    self.labels_buffer,
+                    self.free_slots,
+                    self.full_slots,
+                    num_worker,
+                ),
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            self.free_slots.put(None)
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = []
+
+    def dequeue(self):
+        slot = self.full_slots.get()
+        (images, labels) = (self.images_array[slot].copy(), self.labels_array[slot].copy())
+        self.free_slots.put(slot)
+        return (images, labels)
+
+    def blob(self):
+        # workers are forked before any session exists in this process
+        self.start()
+
+        with tf.variable_scope(_(None)):
+            (self.images, self.labels) = tf.py_func(
+                self.dequeue,
+                [],
+                [self.processor.dtype, tf.int64],
+                stateful=True,
+            )
+            self.images.set_shape((self.batch_size,) + self.shape)
+            self.labels.set_shape((self.batch_size,))
+
+        return Blob(images=self.images, labels=self.labels)
+
+
+class RecordFileProducer(ClassifyProducer):
+    IndexFileName = 'index.txt'
+    ShardFileName = 'shard-{:05d}-of-{:05d}.tfrecord'
+    Features = {
+        'file_name': tf.FixedLenFeature((), dtype=tf.string),
+        'content': tf.FixedLenFeature((), dtype=tf.string),
+        'label': tf.FixedLenFeature((), dtype=tf.int64),
+    }
+    ShuffleSize = 4096  # records, shards are read in the same order every epoch
+
+    @staticmethod
+    def pack(image_dir,
+             record_dir,
+             num_shards=256,
+             subsample_fn=ImageNetFileProducer.SubsampleFunction.NoSubsample(),
+             seed=0):
+
+        if not os.path.isdir(record_dir):
+            os.makedirs(record_dir)
+
+        producer = ImageNetFileProducer(
+            working_dir=record_dir,
+            image_dir=image_dir,
+            subsample_fn=subsample_fn,
+        )
+
+        filename_labels = producer.get_filename_labels()
+
+        # shuffle once so that sequential reads within a shard are well mixed
+        filename_labels.sort()
+        indices = np.random.RandomState(seed).permutation(len(filename_labels))
+        filename_labels = [filename_labels[index] for index in indices]
+
+        num_shards = max(min(num_shards, len(filename_labels)), 1)
+        with open(os.path.join(record_dir, RecordFileProducer.IndexFileName), 'w') as index_file:
+            for num_shard in xrange(num_shards):
+                shard_name = RecordFileProducer.ShardFileName.format(num_shard, num_shards)
+                shard_filename_labels = filename_labels[num_shard::num_shards]
+
+                with tf.python_io.TFRecordWriter(os.path.join(record_dir, shard_name)) as writer:
+                    for (file_name, label) in shard_filename_labels:
+                        with open(file_name, 'rb') as f:
+                            content = f.read()
+
+                        example = tf.train.Example(features=tf.train.Features(feature={
+                            'file_name': tf.train.Feature(bytes_list=tf.train.BytesList(value=[file_name])),
+                            'content': tf.train.Feature(bytes_list=tf.train.BytesList(value=[content])),
+                            'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+                        }))
+                        writer.write(example.SerializeToString())
+
+                index_file.write('{:s} {:d}\n'.format(shard_name, len(shard_filename_labels)))
+                print('Shard {:s} ({:d})'.format(shard_name, len(shard_filename_labels)))
+
+    def __init__(self,
+                 working_dir=None,
+                 record_dir=None,
+                 batch_size=64,
+                 num_parallels=8,
+                 shuffle_size=ShuffleSize):
+
+        self.record_dir = record_dir
+
+        super(RecordFileProducer, self).__init__(
+            working_dir=working_dir,
+            batch_size=batch_size,
+        )
+
+        self.shard_paths = []
+        self.num_files = 0
+        with open(os.path.join(record_dir, RecordFileProducer.IndexFileName), 'r') as index_file:
+            for line in index_file:
+                (shard_name, num_records) = line.split()
+                self.shard_paths.append(os.path.join(record_dir, shard_name))
+                self.num_files += int(num_records)
+
+        self.num_batches_per_epoch = self.num_files // self.batch_size
+        self.num_parallels = num_parallels
+        self.shuffle_size = shuffle_size
+
+    def get_class_names(self):
+        return np.loadtxt(
+            os.path.join(self.record_dir, ClassifyProducer.ClassNameFileName),
+            dtype=np.str,
+        )
+
+    def blob(self):
+        with tf.variable_scope(_(None)):
+            shard_queue = tf.train.string_input_producer(self.shard_paths, shuffle=True, name='shards')
+
+            # each reader streams its own shard, so shards are interleaved across readers
+            filename_content_labels = []
+            for num_parallel in xrange(self.num_parallels):
+                (_key, serialized) = tf.TFRecordReader().read(shard_queue)
+                features = tf.parse_single_example(serialized, features=RecordFileProducer.Features)
+                filename_content_labels.append([
+                    features['file_name'],
+                    features['content'],
+                    features['label'],
+                ])
+
+            # records within a shard come in packed order, so they are mixed again before batching
+            filename_content_label_queue = BaseProducer.queue_join(
+                filename_content_labels,
+                min_after_dequeue=self.shuffle_size,
+            )
+            (self.filenames, self.contents, self.labels) = filename_content_label_queue.dequeue_many(self.batch_size)
+
+        return Blob(contents=self.contents, labels=self.labels)
+
+
+class ImageStoreProducer(ClassifyProducer):
+    DataFileName = 'images.bin'
+    IndexFileName = 'index.npy'  # rows of (offset, height, width, label)
+
+    @staticmethod
+    def pack(image_dir,
+             store_dir,
+             processor=None,
+             shorter_dim=None,
+             subsample_fn=ImageNetFileProducer.SubsampleFunction.NoSubsample(),
+             seed=0):
+
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        # by default, the largest shorter side the processor resizes to, aspect stretches are left to its resize
+        processor = processor or TrainProcessor()
+        shorter_dim = shorter_dim or int(processor.shorter_dim.bounds()[1])
+
+        producer = ImageNetFileProducer(
+            working_dir=store_dir,
+            image_dir=image_dir,
+            subsample_fn=subsample_fn,
+        )
+
+        filename_labels = sorted(producer.get_filename_labels())
+        indices = np.random.RandomState(seed).permutation(len(filename_labels))
+        filename_labels = [filename_labels[index] for index in indices]
+
+        with tf.Graph().as_default():
+            content = tf.placeholder(tf.string, shape=())
+            image = BaseProcessor._decode_jpeg_uint8(content, min_dim=shorter_dim)
+
+            # only shrink, so that the shorter side is no smaller than what the processor resizes to
+            (height, width) = BaseProcessor._height_and_width(image)
+            scale = shorter_dim / tf.to_float(tf.minimum(height, width))
+            image = tf.cond(
+                tf.less(scale, 1.0),
+                lambda: BaseProcessor._to_uint8(tf.image.resize_images(
+                    image,
+                    tf.to_int32(tf.round(scale * tf.to_float(tf.stack([height, width])))),
+                    method=tf.image.ResizeMethod.BILINEAR,
+                )),
+                lambda: image,
+            )
+
+            index = []
+            offset = 0
+            with tf.Session() as sess, open(os.path.join(store_dir, ImageStoreProducer.DataFileName), 'wb') as data_file:
+                for (num_file, (file_name, label)) in enumerate(filename_labels):
+                    with open(file_name, 'rb') as f:
+                        content_ = f.read()
+
+                    try:
+                        image_ = sess.run(image, feed_dict={content: content_})
+                    except tf.errors.OpError:
+                        print('Skipping {:s}'.format(file_name))
+                        continue
+
+                    data_file.write(image_.tobytes())
+                    index.append((offset, image_.shape[0], image_.shape[1], label))
+                    offset += image_.size
+
+                    if (num_file + 1) % 1000 == 0:
+                        print('Stored {:d}/{:d}'.format(num_file + 1, len(filename_labels)))
+
+        np.save(os.path.join(store_dir, ImageStoreProducer.IndexFileName), np.array(index, dtype=np.int64))
+
+    def __init__(self,
+                 processor,
+                 working_dir=None,
+                 store_dir=None,
+                 batch_size=64,
+                 num_parallels=8):
+
+        self.store_dir = store_dir
+
+        super(ImageStoreProducer, self).__init__(
+            working_dir=working_dir,
+            batch_size=batch_size,
+        )
+
+        self.processor = processor
+        self.index = np.load(os.path.join(store_dir, ImageStoreProducer.IndexFileName))
+        self.data = np.memmap(os.path.join(store_dir, ImageStoreProducer.DataFileName), dtype=np.uint8, mode='r')
+
+        self.num_files = len(self.index)
+        self.num_batches_per_epoch = self.num_files // self.batch_size
+        self.num_parallels = num_parallels
+
+    def get_class_names(self):
+        return np.loadtxt(
+            os.path.join(self.store_dir, ClassifyProducer.ClassNameFileName),
+            dtype=np.str,
+        )
+
+    def blob(self):
+        def read(index):
+            (offset, height, width, label) = self.index[index]
+            image = self.data[offset:offset + height * width * 3].reshape((height, width, 3))
+            return (np.array(image), label)
+
+        with tf.variable_scope(_(None)):
+            index_queue = tf.train.range_input_producer(self.num_files, shuffle=True)
+
+            # images stay uint8 from the store until the processor needs otherwise
+            image_labels = []
+            for num_parallel in xrange(self.num_parallels):
+                (image, label) = tf.py_func(read, [index_queue.dequeue()], [tf.uint8, tf.int64], stateful=False)
+                image.set_shape((None, None, 3))
+                label.set_shape(())
+
+                images = self.processor.preprocess_decoded(self.processor.convert_image(image))
+                image_labels.append([images, label])
+
+            image_label_queue = BaseProducer.queue_join(image_labels)
+            (self.images, self.labels) = image_label_queue.dequeue_many(self.batch_size)
+
+        return Blob(images=self.images, labels=self.labels)
+
+
+class FeatureProducer(ClassifyProducer):
+    FeatsFileName = 'feats.npy'
+    LabelsFileName = 'labels.npy'
+    CkptPathFileName = 'ckpt_path.txt'
+    NumFeats = 2048
+
+    @staticmethod
+    def pack(image_dir,
+             store_dir,
+             source_working_dir,
+             processor=None,
+             batch_size=64,
+             subsample_fn=ImageNetFileProducer.SubsampleFunction.NoSubsample()):
+
+        from .net import ClassifyNet, OnlineScheme
+
+        class Net(ClassifyNet, OnlineScheme):
+            pass
+
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        producer = ImageNetFileProducer(
+            working_dir=store_dir,
+            image_dir=image_dir,
+            subsample_fn=subsample_fn,
+        )
+        filename_labels = sorted(producer.get_filename_labels())
+
+        # every repeat of the processor is one fixed augmentation, and one row in the store
+        processor = processor or TestProcessor(batch_size=batch_size)
+
+        with tf.Graph().as_default():
+            source_producer = PlaceholderProducer(
+                working_dir=source_working_dir,
+                batch_size=batch_size,
+            )
+            net = Net(
+                working_dir=source_working_dir,
+                num_classes=source_producer.num_classes,
+                output_attrs=['feats_2048'],
+            )
+            blob = (
+                source_producer.blob()
+                .f(processor.preprocess)
+                .f(net.build)
+            )
+            net.run()
+
+            num_repeats = processor.num_repeats
+            tmp_path = os.path.join(store_dir, FeatureProducer.FeatsFileName + '.tmp')
+            feats = np.lib.format.open_memmap(
+                tmp_path,
+                mode='w+',
+                dtype=np.float16,
+                shape=(len(filename_labels) * num_repeats, FeatureProducer.NumFeats),
+            )
+            labels = -np.ones((len(filename_labels) * num_repeats,), dtype=np.int64)
+
+            def extract(file_names):
+                return net.sess.run(blob['feats_2048'], feed_dict={source_producer.file_names: file_names})
+
+            for offset in xrange(0, len(filename_labels), batch_size):
+                (file_names, file_labels) = zip(*filename_labels[offset:offset + batch_size])
+
+                # rows of undecodable images keep label -1 and are never read
+                try:
+                    feats[offset * num_repeats:(offset + len(file_names)) * num_repeats] = extract(file_names)
+                    labels[offset * num_repeats:(offset + len(file_names)) * num_repeats] = np.repeat(file_labels, num_repeats)
+                except tf.errors.OpError:
+                    for (num_file, (file_name, file_label)) in enumerate(zip(file_names, file_labels)):
+                        begin = (offset + num_file) * num_repeats
+                        try:
+                            feats[begin:begin + num_repeats] = extract([file_name])
+                            labels[begin:begin + num_repeats] = file_label
+                        except tf.errors.OpError:
+                            print('Skipping {:s}'.format(file_name))
+
+                print('Extracted {:d}/{:d}'.format(offset + len(file_names), len(filename_labels)))
+
+            net.sess.close()
+
+        feats.flush()
+        del feats
+
+        np.save(os.path.join(store_dir, FeatureProducer.LabelsFileName), labels)
+        with open(os.path.join(store_dir, FeatureProducer.CkptPathFileName), 'w') as f:
+            f.write(net.restored_ckpt_path)
+        os.rename(tmp_path, os.path.join(store_dir, FeatureProducer.FeatsFileName))
+
+    def __init__(self,
+                 working_dir=None,
+                 store_dir=None,
+                 batch_size=256):
+
+        self.store_dir = store_dir
+
+        super(FeatureProducer, self).__init__(
+            working_dir=working_dir,
+            batch_size=batch_size,
+        )
+
+        self.feats = np.load(os.path.join(store_dir, FeatureProducer.FeatsFileName), mmap_mode='r')
+        self.feat_labels = np.load(os.path.join(store_dir, FeatureProducer.LabelsFileName))
+        with open(os.path.join(store_dir, FeatureProducer.CkptPathFileName), 'r') as f:
+            self.ckpt_path = f.read().strip()  # the backbone the features were extracted with
+
+        self.indices = np.flatnonzero(self.feat_labels >= 0)
+        self.num_files = len(self.indices)
+        self.num_batches_per_epoch = self.num_files // self.batch_size
+
+    def get_class_names(self):
+        return np.loadtxt(
+            os.path.join(self.store_dir, ClassifyProducer.ClassNameFileName),
+            dtype=np.str,
+        )
+
+    def blob(self):
+        def read(indices):
+            indices = np.sort(self.indices[indices])
+            return (self.feats[indices].astype(np.float32), self.feat_labels[indices])
+
+        with tf.variable_scope(_(None)):
+            indices = tf.train.range_input_producer(self.num_files, shuffle=True).dequeue_many(self.batch_size)
+            (self.feats_2048, self.labels) = tf.py_func(read, [indices], [tf.float32, tf.int64], stateful=False)
+            self.feats_2048.set_shape((None, FeatureProducer.NumFeats))
+            self.labels.set_shape((None,))
+
+        return Blob(feats_2048=self.feats_2048, labels=self.labels)
+
+
 class PlaceholderProducer(ClassifyProducer):
     def __init__(self,
                  working_dir=None,
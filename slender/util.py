@@ -1,5 +1,4 @@
 import os
-import tensorflow as tf
 import time
 
 
@@ -21,8 +20,10 @@ def scope_join_fn(scope):
     return scope_join
 
 
-def LOG(value, name=None, fn=tf.identity):
-    value = tf.Print(value, [fn(value)], '{}: '.format(name or value.__name__))
+def LOG(value, name=None, fn=None):
+    import tensorflow as tf  # util is imported by tools that never touch tensorflow
+
+    value = tf.Print(value, [(fn or tf.identity)(value)], '{}: '.format(name or value.__name__))
     return value
 
 